@@ -1,12 +1,809 @@
-import serial, time, logging, json, struct, queue, traceback # type: ignore
+import serial, time, logging, json, traceback, collections, math, heapq, re, os # type: ignore
 from datetime import datetime
+from . import ace_protocol, ace_state, ace_trace, ace_capture, ace_material
+
+# Lower goes first: stops before movement, movement before queries and drying
+METHOD_PRIORITY = {
+    'stop_feed_assist': 0,
+    'stop_feed_filament': 0,
+    'stop_unwind_filament': 0,
+    'drying_stop': 0,
+    'feed_filament': 1,
+    'unwind_filament': 1,
+    'start_feed_assist': 1,
+    'update_feeding_speed': 1,
+    'update_unwinding_speed': 1,
+    'get_info': 2,
+    'get_status': 2,
+    'drying': 3,
+}
+DEFAULT_PRIORITY = 1
+
+# Spool slots per ACE unit, tool numbers run across units in config order
+SLOT_COUNT = 4
+
+# Lookahead for the next toolchange in the file being printed
+NEXT_TOOL_RE = re.compile(rb'^[ \t]*(?:T|ACE_CHANGE_TOOL[ \t]+TOOL=)(\d+)\b', re.M | re.I)
+STAGE_SCAN_BYTES = 1 << 20
+
+# Persistent state, values from save_variables are carried over on the first start
+STATE_DEFAULTS = {
+    'ace_current_index': -1,
+    'ace_filament_pos': 'spliter',
+    'ace_staged': {},
+    'ace_calibration': {},
+    'ace_tool_map': {},
+    'ace_tool_map_content': {},
+}
+
+# How endless spool decides a slot holds the same filament
+ENDLESS_SPOOL_MATCH = {'sku': 'sku', 'type_color': 'type_color', 'type': 'type'}
+
+# Requests that only express the latest intent for a slot, a newer one replaces a queued one
+COALESCE_GROUPS = {
+    'start_feed_assist': 'feed_assist',
+    'stop_feed_assist': 'feed_assist',
+    'drying': 'drying',
+    'drying_stop': 'drying',
+}
+
+# What reaches klippy.log, every level includes the anomalies
+LOG_ERRORS = 0
+LOG_COMMANDS = 1
+LOG_FRAMES = 2
+LOG_LEVELS = {'errors': LOG_ERRORS, 'commands': LOG_COMMANDS, 'frames': LOG_FRAMES}
+
+# At most one automatic trace dump per unit in this many seconds
+TRACE_DUMP_INTERVAL = 60.
+
+class AceRequestQueue:
+    def __init__(self):
+        self._heap = []
+        self._seq = 0
+        self._latest = {}
+        self._size = 0
+        self.coalesced = 0
+
+    def put(self, task):
+        key = task.coalesce_key
+        if key is not None:
+            previous = self._latest.get(key)
+            if previous is not None and not previous.cancelled:
+                # The newer request answers anyone waiting on the replaced one
+                previous.cancelled = True
+                task.superseded.append(previous)
+                task.superseded.extend(previous.superseded)
+                previous.superseded = []
+                self._size -= 1
+                self.coalesced += 1
+            self._latest[key] = task
+
+        self._seq += 1
+        heapq.heappush(self._heap, (task.priority, self._seq, task))
+        self._size += 1
+
+    def _discard_cancelled(self):
+        while self._heap and self._heap[0][2].cancelled:
+            heapq.heappop(self._heap)
 
-class PeekableQueue(queue.Queue):
     def peek(self):
-        with self.mutex:  # 使用内部锁保证线程安全
-            if len(self.queue) == 0:
-                return None
-            return self.queue[0]
+        self._discard_cancelled()
+        if not self._heap:
+            return None
+        return self._heap[0][2]
+
+    def get(self):
+        self._discard_cancelled()
+        task = heapq.heappop(self._heap)[2]
+        self._size -= 1
+        if task.coalesce_key is not None and self._latest.get(task.coalesce_key) is task:
+            del self._latest[task.coalesce_key]
+        return task
+
+    def empty(self):
+        return self._size == 0
+
+    def __len__(self):
+        return self._size
+
+    def expire(self, eventtime):
+        # Removes and returns queued requests whose deadline has passed
+        expired = [entry[2] for entry in self._heap
+                   if not entry[2].cancelled and entry[2].expires is not None and entry[2].expires <= eventtime]
+        for task in expired:
+            task.cancelled = True
+            self._size -= 1
+            if task.coalesce_key is not None and self._latest.get(task.coalesce_key) is task:
+                del self._latest[task.coalesce_key]
+        return expired
+
+    def next_expiry(self):
+        expiries = [entry[2].expires for entry in self._heap
+                    if not entry[2].cancelled and entry[2].expires is not None]
+        return min(expiries) if expiries else None
+
+    def has_pending(self, key):
+        return key in self._latest
+
+    def drain(self):
+        # In the order they would have been sent
+        tasks = [entry[2] for entry in sorted(self._heap) if not entry[2].cancelled]
+        self._heap = []
+        self._latest = {}
+        self._size = 0
+        return tasks
+
+# kind: 'status', 'slot_status', 'slot_content' (also for every slot on the first
+#       heartbeat of a link), 'dryer_status', 'temp', 'feed_assist_count' or 'update'
+#       (every heartbeat, old/new are whole snapshots)
+# index: slot index for slot events, None otherwise
+StatusEvent = collections.namedtuple('StatusEvent', ['kind', 'index', 'old', 'new'])
+
+class AceRequest:
+    def __init__(self, reactor, request, callback, with_retry, priority=None, expires=None, on_error=None):
+        self.request = request
+        self.callback = callback
+        self.with_retry = with_retry
+        self.retries = 0
+        self.deadline = 0.
+        self.sent_time = None
+        self.response = None
+        self.completion = reactor.completion()
+
+        method = request.get('method')
+        if priority is None:
+            priority = METHOD_PRIORITY.get(method, DEFAULT_PRIORITY)
+        self.priority = priority
+        # Absolute reactor time after which the request is abandoned, None to never give up
+        self.expires = expires
+        self.on_error = on_error
+        self.cancelled = False
+        self.superseded = []
+        self.coalesce_key = None
+        if method in COALESCE_GROUPS:
+            self.coalesce_key = (COALESCE_GROUPS[method], (request.get('params') or {}).get('index'))
+
+    def complete(self, response):
+        self.response = response
+        self.completion.complete(response)
+        for task in self.superseded:
+            task.complete(response)
+        self.superseded = []
+
+    def wait(self, waketime):
+        # Returns the response, or None if it timed out or was never answered
+        return self.completion.wait(waketime)
+
+class AceProfiler:
+    def __init__(self, reactor, max_samples=200):
+        self.reactor = reactor
+        self.max_samples = max_samples
+        self._samples = {}
+        self._counts = {}
+        self._stats = None
+
+    def record(self, key, phase, duration):
+        key = str(key)
+        phases = self._samples.setdefault(key, {})
+        if phase not in phases:
+            phases[phase] = collections.deque(maxlen=self.max_samples)
+        phases[phase].append(duration)
+        counts = self._counts.setdefault(key, {})
+        counts[phase] = counts.get(phase, 0) + 1
+        self._stats = None
+
+    def measure(self, key, phase):
+        return AceProfilerPhase(self, key, phase)
+
+    def reset(self):
+        self._samples = {}
+        self._counts = {}
+        self._stats = None
+
+    def get_stats(self):
+        # Summaries are only rebuilt after new samples arrive
+        if self._stats is None:
+            self._stats = {
+                key: {phase: self._summarize(samples, self._counts[key][phase])
+                      for phase, samples in phases.items()}
+                for key, phases in self._samples.items()}
+        return self._stats
+
+    def _summarize(self, samples, count):
+        ordered = sorted(samples)
+        def percentile(p):
+            return round(ordered[max(0, int(math.ceil(p * len(ordered))) - 1)], 3)
+        return {'count': count, 'min': round(ordered[0], 3), 'p50': percentile(0.5),
+                'p95': percentile(0.95), 'max': round(ordered[-1], 3)}
+
+class AceProfilerPhase:
+    def __init__(self, profiler, key, phase):
+        self.profiler = profiler
+        self.key = key
+        self.phase = phase
+        self.start = None
+
+    def __enter__(self):
+        self.start = self.profiler.reactor.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        # Failed phases are left out, they would skew the timings
+        if exc_type is None:
+            self.profiler.record(self.key, self.phase, self.profiler.reactor.monotonic() - self.start)
+        return False
+
+class AceToolMap:
+    # Shared by every [ace] section: maps T0..T(4N-1) to (unit, slot), holds
+    # the current tool and runs toolchanges that may span two units
+    def __init__(self, config):
+        self.printer = printer = config.get_printer()
+        self.reactor = printer.get_reactor()
+        self.gcode = printer.lookup_object('gcode')
+
+        # State is journaled off the G-code path, save_variables only mirrors it for macros
+        save_variables = printer.lookup_object('save_variables')
+        state_file = config.get('state_file', None)
+        if state_file is None:
+            state_file = os.path.join(os.path.dirname(save_variables.filename), 'ace_state.jsonl')
+        self.variables = ace_state.AceStateStore(os.path.expanduser(state_file), mirror=save_variables.allVariables)
+        if not self.variables.load():
+            for key, default in STATE_DEFAULTS.items():
+                self.variables[key] = save_variables.allVariables.get(key, default)
+        for key, default in STATE_DEFAULTS.items():
+            if key not in self.variables:
+                self.variables[key] = default
+        self.variables.start()
+        printer.register_event_handler('klippy:disconnect', self._handle_disconnect)
+
+        # On runout the print carries on from a ready slot with the same filament,
+        # the T-number is remapped to it
+        self.endless_spool = config.getboolean('endless_spool', False)
+        self.endless_spool_match = config.getchoice('endless_spool_match', ENDLESS_SPOOL_MATCH, 'type_color')
+        # Speed back to the print after the swap, mm/s; the move includes Z
+        self.endless_spool_move_speed = config.getfloat('endless_spool_move_speed', 50., above=0.)
+
+        self.units = []
+        self._tools = []
+        self._sensor_handlers = {}
+        self._slot_content = {}
+        self._material_cache = {}
+        self._runout_pending = False
+        self._status = None
+        self._status_key = None
+
+        self.gcode.register_command(
+            'ACE_GET_CUR_INDEX', self.cmd_ACE_GET_CUR_INDEX,
+            desc=self.cmd_ACE_GET_CUR_INDEX_help
+        )
+        self.gcode.register_command(
+            'ACE_REJECT_TOOL', self.cmd_ACE_REJECT_TOOL,
+            desc=self.cmd_ACE_REJECT_TOOL_help)
+        self.gcode.register_command(
+            'ACE_CHANGE_TOOL', self.cmd_ACE_CHANGE_TOOL,
+            desc=self.cmd_ACE_CHANGE_TOOL_help)
+        self.gcode.register_command(
+            'ACE_FILAMENT_STATUS', self.cmd_ACE_FILAMENT_STATUS,
+            desc=self.cmd_ACE_FILAMENT_STATUS_help)
+        self.gcode.register_command(
+            'ACE_CLEAR_ALL_STATUS', self.cmd_ACE_CLEAR_ALL_STATUS,
+            desc=self.cmd_ACE_CLEAR_ALL_STATUS_help)
+        self.gcode.register_command(
+            'ACE_PREPARE_TOOL', self.cmd_ACE_PREPARE_TOOL,
+            desc=self.cmd_ACE_PREPARE_TOOL_help)
+        self.gcode.register_command(
+            'ACE_UNSTAGE', self.cmd_ACE_UNSTAGE,
+            desc=self.cmd_ACE_UNSTAGE_help)
+        self.gcode.register_command(
+            'ACE_CALIBRATE', self.cmd_ACE_CALIBRATE,
+            desc=self.cmd_ACE_CALIBRATE_help)
+        self.gcode.register_command(
+            'ACE_ENDLESS_SPOOL', self.cmd_ACE_ENDLESS_SPOOL,
+            desc=self.cmd_ACE_ENDLESS_SPOOL_help)
+        self.gcode.register_command(
+            'ACE_REMAP_TOOL', self.cmd_ACE_REMAP_TOOL,
+            desc=self.cmd_ACE_REMAP_TOOL_help)
+        self.gcode.register_command(
+            'ACE_MATERIALS', self.cmd_ACE_MATERIALS,
+            desc=self.cmd_ACE_MATERIALS_help)
+        self.printer.register_event_handler('idle_timeout:idle', self._handle_idle)
+
+    def add_unit(self, unit):
+        first_tool = len(self._tools)
+        self.units.append(unit)
+        self._tools.extend((unit, slot) for slot in range(SLOT_COUNT))
+        return first_tool
+
+    def lookup(self, tool):
+        if tool < 0 or tool >= len(self._tools):
+            return None
+        return self._tools[tool]
+
+    def resolve(self, tool):
+        # T-number from the print to the tool that feeds it
+        if tool < 0:
+            return tool
+        return self.variables.get('ace_tool_map', {}).get(str(tool), tool)
+
+    def get_status(self, eventtime=None):
+        key = (self.variables.version, self.endless_spool)
+        if self._status is None or self._status_key != key:
+            self._status_key = key
+            self._status = {
+                'current_tool': self.variables.get('ace_current_index', -1),
+                'filament_pos': self.variables.get('ace_filament_pos', 'spliter'),
+                'tool_count': len(self._tools),
+                'units': tuple(unit.name for unit in self.units),
+                'staged': self.variables.get('ace_staged', {}),
+                'calibration': self.variables.get('ace_calibration', {}),
+                'tool_map': self.variables.get('ace_tool_map', {}),
+                'endless_spool': self.endless_spool,
+            }
+        return self._status
+
+    def _handle_disconnect(self):
+        self.variables.close()
+
+    def get_staged(self, tool):
+        return self.variables.get('ace_staged', {}).get(str(tool), 0.)
+
+    def set_staged(self, tool, length):
+        # Kept by global tool number so it survives a restart mid-print
+        staged = dict(self.variables.get('ace_staged', {}))
+        if length > 0:
+            staged[str(tool)] = length
+        else:
+            staged.pop(str(tool), None)
+        self.variables['ace_staged'] = staged
+
+    def get_calibration(self, tool):
+        return self.variables.get('ace_calibration', {}).get(str(tool), {})
+
+    def set_calibration(self, tool, lengths):
+        calibration = dict(self.variables.get('ace_calibration', {}))
+        if lengths:
+            calibration[str(tool)] = lengths
+        else:
+            calibration.pop(str(tool), None)
+        self.variables['ace_calibration'] = calibration
+
+    def note_slot_content(self, tool, slot):
+        # Remembered for matching, the ACE may forget what was in a slot once it runs out
+        if slot.get('type') or slot.get('sku'):
+            self._slot_content[tool] = {'sku': slot.get('sku'), 'type': slot.get('type'),
+                                        'color': list(slot.get('color') or ())}
+            self._check_mapped_content(tool)
+
+    def _set_tool_map(self, tool_map):
+        # What each target held when mapped, a different spool there later ends the mapping
+        content = {str(physical): self._slot_content[physical]
+                   for physical in set(tool_map.values()) if physical in self._slot_content}
+        self.variables['ace_tool_map'] = tool_map
+        self.variables['ace_tool_map_content'] = content
+
+    def _check_mapped_content(self, tool):
+        content = self.variables.get('ace_tool_map_content', {}).get(str(tool))
+        current = self._slot_content[tool]
+        if content is None or content == current or self._same_filament(content, current):
+            return
+        tool_map = {logical: physical for logical, physical in self.variables.get('ace_tool_map', {}).items()
+                    if physical != tool}
+        self._set_tool_map(tool_map)
+        self.gcode.respond_info(f'ACE: tool {tool} holds another filament now, T-numbers mapped to it are restored')
+
+    def resolve_material(self, slot):
+        # Profiles are fixed once the config is loaded, a lookup is kept per sku and type
+        key = (slot.get('sku') or '', (slot.get('type') or '').upper())
+        if key not in self._material_cache:
+            self._material_cache[key] = ace_material.find(self.printer, *key)
+        return self._material_cache[key]
+
+    def _same_filament(self, content, slot):
+        if self.endless_spool_match == 'sku':
+            return bool(content['sku']) and content['sku'] == slot.get('sku')
+        if not content['type'] or content['type'] != slot.get('type'):
+            return False
+        return self.endless_spool_match == 'type' or content['color'] == list(slot.get('color') or ())
+
+    def _find_spare(self, tool):
+        unit, slot = self._tools[tool]
+        content = self._slot_content.get(tool)
+        if content is None:
+            return None
+
+        best = None
+        for candidate, (other, other_slot) in enumerate(self._tools):
+            if candidate == tool:
+                continue
+            info = other._info['slots'][other_slot]
+            if info.get('status') != 'ready' or not self._same_filament(content, info):
+                continue
+            # Same unit first, the load then doesn't wait on another unit's hub retract
+            rank = (other is not unit, candidate)
+            if best is None or rank < best[0]:
+                best = (rank, candidate)
+        return best[1] if best is not None else None
+
+    def _remap(self, tool, spare):
+        # Every T-number fed by tool moves to spare, returns the lowest of them
+        tool_map = {}
+        moved = []
+        for logical in range(len(self._tools)):
+            physical = self.resolve(logical)
+            if physical == tool:
+                physical = spare
+                moved.append(logical)
+            if physical != logical:
+                tool_map[str(logical)] = physical
+        self._set_tool_map(tool_map)
+        return moved[0] if moved else spare
+
+    def _printing(self):
+        idle_timeout = self.printer.lookup_object('idle_timeout', None)
+        return idle_timeout is not None and idle_timeout.get_status(self.reactor.monotonic())['state'] == 'Printing'
+
+    def handle_runout(self, tool, source):
+        # From the heartbeat; only a tool loaded to the nozzle runs out, during
+        # a toolchange the slots change on purpose
+        if not self.endless_spool or self._runout_pending:
+            return
+        if tool != self.variables.get('ace_current_index', -1):
+            return
+        if self.variables.get('ace_filament_pos', 'spliter') != 'nozzle' or not self._printing():
+            return
+        self._runout_pending = True
+        self.reactor.register_callback(lambda eventtime: self._endless_spool(tool, source))
+
+    def _endless_spool(self, tool, source):
+        # Like a runout sensor, the swap runs between two lines of the print
+        saved = False
+        try:
+            unit = self._tools[tool][0]
+            if self._tail_past_sensor(unit):
+                # Unloading pulls until the extruder sensor clears, a tail already past
+                # it would stay in the toolhead under the new filament
+                self.gcode.respond_info(f'ACE: tool {tool} ran out ({source}) past the extruder sensor, '
+                                        'clear the toolhead by hand')
+                self.gcode.run_script('_ACE_ON_EMPTY_ERROR INDEX=' + str(tool))
+                return
+            spare = self._find_spare(tool)
+            if spare is None:
+                self.gcode.respond_info(f'ACE: tool {tool} ran out ({source}), no spool with the same filament')
+                self.gcode.run_script('_ACE_ON_EMPTY_ERROR INDEX=' + str(tool))
+                return
+            logical = self._remap(tool, spare)
+            self.gcode.respond_info(f'ACE: tool {tool} ran out ({source}), T{logical} continues from tool {spare}')
+            # Unlike a slicer toolchange no travel move follows, the print must
+            # carry on from where it stopped and not from the purge location
+            self.gcode.run_script('SAVE_GCODE_STATE NAME=ACE_ENDLESS_SPOOL')
+            saved = True
+            self.gcode.run_script(f'ACE_CHANGE_TOOL TOOL={logical}\n{self._restore_print()}\nM400')
+        except Exception as e:
+            logging.exception('ACE: endless spool failed')
+            self.gcode.respond_info(f'ACE: endless spool failed: {e}')
+            if saved:
+                # Paused over the print, RESUME continues from there
+                try:
+                    self.gcode.run_script(f'{self._restore_print()}\n_ACE_ON_EMPTY_ERROR INDEX={tool}')
+                except Exception:
+                    logging.exception('ACE: pausing after endless spool failed')
+        finally:
+            self._runout_pending = False
+
+    def _restore_print(self):
+        return f'RESTORE_GCODE_STATE NAME=ACE_ENDLESS_SPOOL MOVE=1 MOVE_SPEED={self.endless_spool_move_speed:g}'
+
+    def _handle_idle(self, print_time):
+        # A print that ended or was aborted leaves staged filament in the bowdens
+        if self.variables.get('ace_staged'):
+            self.reactor.register_callback(self._unstage_all)
+
+    def _unstage_all(self, eventtime):
+        try:
+            self.gcode.run_script('ACE_UNSTAGE')
+        except Exception as e:
+            logging.exception('ACE: unstage on idle failed')
+            self.gcode.respond_info(f'ACE: unstage failed: {e}')
+
+    def _prepare_tool(self, tool, length=None):
+        unit, slot = self._tools[tool]
+        if tool == self.variables.get('ace_current_index', -1) or self.get_staged(tool) > 0:
+            return
+        if length is None:
+            length = unit.stage_length
+        if length <= 0:
+            self.gcode.respond_info(f'ACE: staging is off for unit {unit.name}, set stage_length')
+            return
+        if unit._info['slots'][slot]['status'] != 'ready':
+            self.gcode.respond_info(f'ACE: not staging tool {tool}, slot {slot} is not ready')
+            return
+
+        unit._stage_tool(slot, length)
+
+    def _scan_next_tool(self, current):
+        sdcard = self.printer.lookup_object('virtual_sdcard', None)
+        if sdcard is None or not sdcard.is_active():
+            return None
+        path = sdcard.file_path()
+        if path is None:
+            return None
+
+        try:
+            with open(path, 'rb') as f:
+                f.seek(sdcard.file_position)
+                data = f.read(STAGE_SCAN_BYTES)
+        except OSError as e:
+            logging.info(f'ACE: lookahead scan of {path} failed: {e}')
+            return None
+        if len(data) == STAGE_SCAN_BYTES:
+            # Don't match on a line that was cut off
+            data = data[:data.rfind(b'\n') + 1]
+
+        for match in NEXT_TOOL_RE.finditer(data):
+            tool = int(match.group(1))
+            if tool != current:
+                return tool
+        return None
+
+    def create_sensor(self, config, pin, name):
+        section = 'filament_switch_sensor %s' % name
+        if self.printer.lookup_object(section, None) is not None:
+            raise config.error(f'ACE: sensor {name} is already defined, give it another name '
+                               f'or leave out the pin to share it')
+        config.fileconfig.add_section(section)
+        config.fileconfig.set(section, 'switch_pin', pin)
+        config.fileconfig.set(section, 'pause_on_runout', 'False')
+        fs = self.printer.load_object(config, section)
+
+        # Hook the runout helper to get the switch edges as they arrive
+        helper = fs.runout_helper
+        note_filament_present = helper.note_filament_present
+        def note_and_notify(*args):
+            note_filament_present(*args)
+            # Newer Klipper passes (eventtime, is_filament_present), older only the state
+            eventtime = args[0] if len(args) > 1 else self.reactor.monotonic()
+            for handler in list(self._sensor_handlers.get(name, ())):
+                handler(eventtime, bool(args[-1]))
+        helper.note_filament_present = note_and_notify
+
+    def register_sensor_handler(self, name, callback):
+        self._sensor_handlers.setdefault(name, []).append(callback)
+
+    def unregister_sensor_handler(self, name, callback):
+        handlers = self._sensor_handlers.get(name, [])
+        if callback in handlers:
+            handlers.remove(callback)
+
+    def _tail_past_sensor(self, unit):
+        sensor = self.printer.lookup_object('filament_switch_sensor %s' % unit.extruder_sensor, None)
+        return sensor is not None and not sensor.runout_helper.filament_present
+
+    def sensor_present(self, name):
+        sensor = self.printer.lookup_object('filament_switch_sensor %s' % name, None)
+        return sensor is not None and bool(sensor.runout_helper.filament_present)
+
+    cmd_ACE_GET_CUR_INDEX_help = 'Get current tool index'
+    def cmd_ACE_GET_CUR_INDEX(self, gcmd):
+        self.gcode.respond_info('ACE Current index {}'.format(self.variables['ace_current_index']))
+
+    cmd_ACE_PREPARE_TOOL_help = 'Feed a tool up to short of the splitter while the current one prints'
+    def cmd_ACE_PREPARE_TOOL(self, gcmd):
+        tool = gcmd.get_int('TOOL')
+        length = gcmd.get_float('LENGTH', None, above=0.)
+
+        if self.lookup(tool) is None:
+            raise gcmd.error('Wrong tool')
+
+        self._prepare_tool(self.resolve(tool), length)
+
+    cmd_ACE_CALIBRATE_help = 'Measure the path lengths to the extruder and toolhead sensors, no tool may be loaded'
+    def cmd_ACE_CALIBRATE(self, gcmd):
+        tool = gcmd.get_int('TOOL', None)
+
+        if tool is not None:
+            if self.lookup(tool) is None:
+                raise gcmd.error('Wrong tool')
+            tools = [tool]
+        else:
+            tools = range(len(self._tools))
+
+        if gcmd.get_int('RESET', 0):
+            for tool in tools:
+                self.set_calibration(tool, None)
+            gcmd.respond_info('ACE: calibration cleared')
+            return
+
+        if self.variables.get('ace_current_index', -1) != -1:
+            raise gcmd.error('ACE: unload the current tool before calibrating')
+
+        for tool in tools:
+            unit, slot = self._tools[tool]
+            if unit._info['slots'][slot]['status'] != 'ready':
+                if len(tools) == 1:
+                    raise gcmd.error(f'ACE: slot {slot} of unit {unit.name} is not ready')
+                continue
+            if self.get_staged(tool) > 0:
+                unit._unstage(slot)
+            lengths = unit._calibrate(slot)
+            gcmd.respond_info(f'ACE: tool {tool} extruder sensor {lengths["extruder"]:.1f}mm, '
+                              f'toolhead sensor {lengths["toolhead"]:.1f}mm')
+
+    cmd_ACE_UNSTAGE_help = 'Unwind staged tools back to the ACE'
+    def cmd_ACE_UNSTAGE(self, gcmd):
+        tool = gcmd.get_int('TOOL', None)
+
+        if tool is not None:
+            tools = [tool]
+        else:
+            tools = sorted(int(t) for t in self.variables.get('ace_staged', {}))
+        for tool in tools:
+            entry = self.lookup(tool)
+            if entry is None:
+                # Left over from a different tool map, nothing to unwind it with
+                self.set_staged(tool, 0)
+                continue
+            unit, slot = entry
+            unit._unstage(slot)
+
+    cmd_ACE_CLEAR_ALL_STATUS_help = 'Clean status'
+    def cmd_ACE_CLEAR_ALL_STATUS(self, gcmd):
+        self.variables['ace_current_index'] = -1
+        self.variables['ace_filament_pos'] = 'spliter'
+        self._set_tool_map({})
+
+    cmd_ACE_REJECT_TOOL_help = 'Reject tool'
+    def cmd_ACE_REJECT_TOOL(self, gcmd):
+        tool = gcmd.get_int('TOOL', -1)
+
+        if -1 == tool:
+            tool = self.variables.get('ace_current_index', -1)
+        if tool == -1:
+            return
+
+        entry = self.lookup(tool)
+        if entry is None:
+            raise gcmd.error('Wrong tool')
+        unit, slot = entry
+        unit._reject_tool(slot)
+
+    cmd_ACE_CHANGE_TOOL_help = 'Changes tool'
+    def cmd_ACE_CHANGE_TOOL(self, gcmd):
+        # self.gcode.respond_info('ACE: Changing tool...')
+        logical = gcmd.get_int('TOOL')
+
+        if logical < -1 or logical >= len(self._tools):
+            raise gcmd.error('Wrong tool')
+        tool = self.resolve(logical)
+
+        was = self.variables.get('ace_current_index', -1)
+        unit = slot = None
+        if tool != -1 and tool != was:
+            unit, slot = self._tools[tool]
+            status = unit._info['slots'][slot]['status']
+            if status != 'ready':
+                spare = self._find_spare(tool) if self.endless_spool else None
+                if spare is None:
+                    self.gcode.run_script_from_command('_ACE_ON_EMPTY_ERROR INDEX=' + str(tool))
+                    return
+                self._remap(tool, spare)
+                gcmd.respond_info(f'ACE: tool {tool} is empty, T{logical} continues from tool {spare}')
+                tool = spare
+                unit, slot = self._tools[tool]
+
+        if was == tool:
+            gcmd.respond_info('ACE: Not changing tool, current index already ' + str(tool))
+            return
+
+        was_unit = was_slot = None
+        if was != -1:
+            entry = self.lookup(was)
+            if entry is None:
+                raise gcmd.error(f'ACE: current tool {was} is not in the tool map, run ACE_CLEAR_ALL_STATUS')
+            was_unit, was_slot = entry
+
+        # Phase timings go to the unit that loads, or the one unloading
+        profiler_unit, key = (unit, slot) if unit is not None else (was_unit, -1)
+        profiler = profiler_unit._profiler
+
+        start_time = self.reactor.monotonic()
+        with profiler.measure(key, 'pre_toolchange'):
+            self.gcode.run_script_from_command('_ACE_PRE_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool)
+                                               + (unit._macro_params(slot) if unit is not None else ''))
+
+        logging.info('ACE: Toolchange ' + str(was) + ' => ' + str(tool))
+        if was_unit is not None:
+            was_unit._reject_tool(was_slot, wait=False)
+
+        if unit is not None:
+            # Past the splitter the path is shared, another unit may only feed
+            # once the old filament is clear of it
+            if was_unit is not None and was_unit is not unit:
+                was_unit._wait_hub_retract()
+            unit._load_tool(slot)
+
+        with profiler.measure(key, 'post_toolchange'):
+            self.gcode.run_script_from_command('_ACE_POST_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool)
+                                               + (unit._macro_params(slot) if unit is not None else ''))
+        # When only unloading, the hub retract overlaps the moves back to the print
+        if was_unit is not None:
+            was_unit._wait_hub_retract()
+        profiler.record(key, 'total', self.reactor.monotonic() - start_time)
+
+        self.variables['ace_current_index'] = tool
+
+        gcmd.respond_info(f'Tool {tool} load')
+
+        if unit is not None and unit.stage_lookahead:
+            next_tool = self._scan_next_tool(logical)
+            if next_tool is not None:
+                next_tool = self.resolve(next_tool)
+            entry = self.lookup(next_tool) if next_tool is not None and next_tool != tool else None
+            if entry is not None and entry[0].stage_lookahead:
+                try:
+                    self._prepare_tool(next_tool)
+                except self.printer.command_error as e:
+                    # Staging is only a head start, the toolchange feeds the rest
+                    gcmd.respond_info(f'ACE: staging tool {next_tool} failed: {e}')
+
+    cmd_ACE_ENDLESS_SPOOL_help = 'Show endless spool and the tool map, ENABLE=0/1 switches it'
+    def cmd_ACE_ENDLESS_SPOOL(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None)
+        if enable is not None:
+            self.endless_spool = bool(enable)
+
+        lines = [f'ACE: endless spool {"on" if self.endless_spool else "off"}, matching by {self.endless_spool_match}']
+        tool_map = self.variables.get('ace_tool_map', {})
+        for logical in sorted(tool_map, key=int):
+            lines.append(f'  T{logical} -> tool {tool_map[logical]}')
+        gcmd.respond_info('\n'.join(lines))
+
+    cmd_ACE_REMAP_TOOL_help = 'Feed a T-number from another tool, TOOL= TO=, or RESET=1 to undo all'
+    def cmd_ACE_REMAP_TOOL(self, gcmd):
+        if gcmd.get_int('RESET', 0):
+            self._set_tool_map({})
+            gcmd.respond_info('ACE: tool map reset')
+            return
+
+        tool = gcmd.get_int('TOOL')
+        to = gcmd.get_int('TO')
+        if self.lookup(tool) is None or self.lookup(to) is None:
+            raise gcmd.error('Wrong tool')
+        tool_map = dict(self.variables.get('ace_tool_map', {}))
+        if to == tool:
+            tool_map.pop(str(tool), None)
+        else:
+            tool_map[str(tool)] = to
+        self._set_tool_map(tool_map)
+        gcmd.respond_info(f'ACE: T{tool} -> tool {to}')
+
+    cmd_ACE_MATERIALS_help = 'Show the material profile used by each slot'
+    def cmd_ACE_MATERIALS(self, gcmd):
+        lines = []
+        for tool, (unit, slot) in enumerate(self._tools):
+            info = unit._info['slots'][slot]
+            material = unit._materials[slot]
+            lines.append(f'Tool {tool}: {info.get("type") or "-"} {info.get("sku") or "-"} -> '
+                         f'{material.name if material is not None else "[" + unit.name + "] defaults"}')
+        gcmd.respond_info('\n'.join(lines))
+
+    cmd_ACE_FILAMENT_STATUS_help = 'ACE Filament status'
+    def cmd_ACE_FILAMENT_STATUS(self, gcmd):
+        entry = self.lookup(self.variables.get('ace_current_index', -1))
+        unit = entry[0] if entry is not None else self.units[0]
+        extruder_present = self.sensor_present(unit.extruder_sensor)
+        toolhead_present = self.sensor_present(unit.toolhead_sensor)
+        state = 'ACE----------|*--|Ex--|*----|Nz--'
+        if  self.variables['ace_filament_pos'] == 'nozzle':
+            state = 'ACE>>>>>>>>>>|*>>|Ex>>|*>>|Nz>>'
+        if  self.variables['ace_filament_pos'] == 'toolhead' and toolhead_present:
+            state = 'ACE>>>>>>>>>>|*>>|Ex>>|*>>|Nz--'
+        if  self.variables['ace_filament_pos'] == 'toolhead' and not toolhead_present:
+            state = 'ACE>>>>>>>>>>|*>>|Ex>>|*--|Nz--'
+        if  self.variables['ace_filament_pos'] == 'bowden' and extruder_present:
+            state = 'ACE>>>>>>>>>>|*>>|Ex--|*--|Nz--'
+        if  self.variables['ace_filament_pos'] == 'bowden' and not extruder_present:
+            state = 'ACE>>>>>>>>>>|*--|Ex--|*--|Nz--'
+        gcmd.respond_info(state)
 
 class DuckAce:
     def __init__(self, config):
@@ -16,27 +813,129 @@ class DuckAce:
         self._name = config.get_name()
         if self._name.startswith('ace '):
             self._name = self._name[4:]
-        self.variables = self.printer.lookup_object('save_variables').allVariables
+        self.name = self._name
+        self.tools = self.printer.lookup_object('ace_tools', None)
+        if self.tools is None:
+            self.tools = AceToolMap(config)
+            self.printer.add_object('ace_tools', self.tools)
+        self.first_tool = self.tools.add_unit(self)
+        self.variables = self.tools.variables
 
         self.serial_name = config.get('serial', '/dev/ttyACM0')
         self.baud = config.getint('baud', 115200)
         extruder_sensor_pin = config.get('extruder_sensor_pin', None)
         toolhead_sensor_pin = config.get('toolhead_sensor_pin', None)
+        # Units feeding one toolhead share its sensors, only one section sets the pins
+        self.extruder_sensor = config.get('extruder_sensor', 'extruder_sensor')
+        self.toolhead_sensor = config.get('toolhead_sensor', 'toolhead_sensor')
         self.feed_speed = config.getint('feed_speed', 50)
         self.retract_speed = config.getint('retract_speed', 50)
         self.toolchange_retract_length = config.getint('toolchange_retract_length', 100)
         self.max_dryer_temperature = config.getint('max_dryer_temperature', 55)
         self.disable_assist_after_toolchange = config.getboolean('disable_assist_after_toolchange', False)
+        self.extruder_sensor_timeout = config.getfloat('extruder_sensor_timeout', 60., above=0.)
+        self.toolhead_approach_speed = config.getfloat('toolhead_approach_speed', 25., above=0.)
+        self.toolhead_approach_length = config.getfloat('toolhead_approach_length', 100., above=0.)
+        self.toolhead_sensor_to_nozzle = config.getfloat('toolhead_sensor_to_nozzle', 0., minval=0.)
+        self.extract_speed = config.getfloat('extract_speed', 10., above=0.)
+        # sensor: extruder sensor edge, rate: feed assist counter rate, legacy: counter hit count
+        self.park_detection = config.getchoice('park_detection', {'sensor': 'sensor', 'rate': 'rate', 'legacy': 'legacy'}, 'sensor')
+        self.park_settle_time = config.getfloat('park_settle_time', 0.5, above=0.)
+        self.park_count_rate = config.getfloat('park_count_rate', 0.5, minval=0.)
+        self.park_assist_time_rate = config.getfloat('park_assist_time_rate', None, minval=0.)
+        self.park_confirm_sensor = config.get('park_confirm_sensor', None)
+        self.park_timeout = config.getfloat('park_timeout', 30., above=0.)
+        self.extract_length = config.getfloat('extract_length', 100., above=0.)
+        # Staged tools are fed this far ahead, short of the splitter, 0 disables staging
+        self.stage_length = config.getfloat('stage_length', 0., minval=0.)
+        self.stage_lookahead = config.getboolean('stage_lookahead', False)
+        if self.stage_length >= self.toolchange_retract_length - 5:
+            raise config.error('ACE: stage_length must be shorter than toolchange_retract_length - 5')
+        # Calibrated slots feed the measured length less the margin at full speed, the
+        # extruder covers all but the margin before the toolhead sensor at toolhead_fast_speed
+        self.calibration_margin = config.getfloat('calibration_margin', 20., above=0.)
+        self.calibration_speed = config.getfloat('calibration_speed', 25., above=0.)
+        self.toolhead_fast_speed = config.getfloat('toolhead_fast_speed', 50., above=0.)
+        self.request_timeout = config.getfloat('request_timeout', 1., above=0.)
+        self.request_retries = config.getint('request_retries', 2, minval=0)
+        self.command_timeout = config.getfloat('command_timeout', 10., above=0.)
+        self.max_inflight = config.getint('max_inflight', 4, minval=1)
+        self.max_missed_heartbeats = config.getint('max_missed_heartbeats', 3, minval=1)
+        self.write_timeout = config.getfloat('write_timeout', 0.1, above=0.)
+        # While the port is missing its path is checked every reconnect_check_interval,
+        # once it exists failed opens back off from reconnect_min_delay to reconnect_max_delay
+        self.reconnect_check_interval = config.getfloat('reconnect_check_interval', 0.1, above=0.)
+        self.reconnect_min_delay = config.getfloat('reconnect_min_delay', 0.05, above=0.)
+        self.reconnect_max_delay = config.getfloat('reconnect_max_delay', 5., above=0.)
+        self.poll_interval = config.getfloat('poll_interval', 0.25, above=0.)
+        self.poll_interval_active = config.getfloat('poll_interval_active', 0.08, above=0.)
+        self.poll_interval_idle = config.getfloat('poll_interval_idle', 3., above=0.)
+        self.idle_timeout = config.getfloat('idle_timeout', 30., minval=0.)
+        # Frames go to an in-memory ring, klippy.log only gets what log_level asks for
+        self.log_level = config.getchoice('log_level', LOG_LEVELS, 'commands')
+        self.trace_size = config.getint('trace_size', 1000, minval=0)
+        self.trace_dump_on_error = config.getboolean('trace_dump_on_error', False)
+        self.trace_dir = config.get('trace_dir', None)
+        # Written into captures so a replay runs with the same settings. Read raw
+        # so Klipper still reports options nothing uses
+        self._config_options = dict(config.fileconfig.items(config.get_name()))
 
-        self._callback_map = {}
+        self._connected = False
+        self._serial = None
+        self._serial_fd = None
+        self._path_present = False
+        self._next_reconnect = 0.
+        self._reconnect_delay = self.reconnect_min_delay
+        self._poll_offset = 0.
+        self._disconnects = 0
+        # Framing, ids and response matching live in the protocol core, its
+        # pending table holds the requests waiting for an answer
+        self._protocol = ace_protocol.AceProtocol()
+        self._inflight = self._protocol.pending
+        self._queue = None
+        self._timeouts = 0
+        self._expired = 0
+        self._heartbeat_id = None
+        self._heartbeat_deadline = 0.
+        self._next_heartbeat = 0.
+        self._missed_heartbeats = 0
+        self._heartbeat_payload = b'{"id": %d, "method": "get_status"}'
+        self._current_poll_interval = self.poll_interval
+        self._active_until = 0.
+        self._last_activity = 0.
+        self._link_rate = 0.
+        self._link_rate_time = 0.
+        self._link_rate_bytes = 0
+        # get_status() hands out this snapshot until something in it changes
+        self._status = None
+        self._status_key = None
+        self._info_version = 0
+        # Set by the first heartbeat on a link, until then _info holds defaults or a stale state
+        self._info_live = False
+        self._status_handlers = {}
         self.park_hit_count = 5
         self._feed_assist_index = -1
         self._last_assist_count = 0
         self._assist_hit_count = 0
         self._park_in_progress = False
-        self._park_is_toolchange = False
-        self._park_previous_tool = -1
         self._park_index = -1
+        self._park_completion = None
+        self._park_started = 0.
+        self._park_samples = collections.deque()
+        self._hub_retract = None
+        self._staging = None
+        self._heartbeat_sent = 0.
+        self._main_queue = None
+        self._main_latency = 0.
+        self._main_latency_max = 0.
+        self._main_errors = 0
+        self._main_last_error = None
+        self._profiler = AceProfiler(self.reactor)
+        self._trace = ace_trace.AceTrace(self.trace_size, self.reactor.monotonic)
+        self._last_trace_dump = None
+        self._capture = None
+        # Material profile per slot, resolved when the slot contents change
+        self._materials = [None] * SLOT_COUNT
 
         self._last_get_ace_response_time = None
 
@@ -86,82 +985,85 @@ class DuckAce:
             ]
         }
 
-        self._create_mmu_sensor(config, extruder_sensor_pin, 'extruder_sensor')
-        self._create_mmu_sensor(config, toolhead_sensor_pin, 'toolhead_sensor')
+        self.register_status_handler('feed_assist_count', self._handle_park_assist_count)
+        self.register_status_handler('update', self._handle_park_update)
+        self.register_status_handler('slot_content', self._handle_slot_content)
+        self.register_status_handler('slot_status', self._handle_slot_status)
+
+        if extruder_sensor_pin is not None:
+            self.tools.create_sensor(config, extruder_sensor_pin, self.extruder_sensor)
+        if toolhead_sensor_pin is not None:
+            self.tools.create_sensor(config, toolhead_sensor_pin, self.toolhead_sensor)
         self.printer.register_event_handler('klippy:ready', self._handle_ready)
         self.printer.register_event_handler('klippy:disconnect', self._handle_disconnect)
 
-        self.gcode.register_command(
-            'ACE_GET_CUR_INDEX', self.cmd_ACE_GET_CUR_INDEX,
-            desc=self.cmd_ACE_GET_CUR_INDEX_help
-        )
-        self.gcode.register_command(
+        # Unit commands take ACE=<name>, [ace] itself is the default without it
+        self._register_unit_command(
             'ACE_START_DRYING', self.cmd_ACE_START_DRYING,
             desc=self.cmd_ACE_START_DRYING_help)
-        self.gcode.register_command(
+        self._register_unit_command(
             'ACE_STOP_DRYING', self.cmd_ACE_STOP_DRYING,
             desc=self.cmd_ACE_STOP_DRYING_help)
-        self.gcode.register_command(
+        self._register_unit_command(
             'ACE_ENABLE_FEED_ASSIST', self.cmd_ACE_ENABLE_FEED_ASSIST,
             desc=self.cmd_ACE_ENABLE_FEED_ASSIST_help)
-        self.gcode.register_command(
+        self._register_unit_command(
             'ACE_DISABLE_FEED_ASSIST', self.cmd_ACE_DISABLE_FEED_ASSIST,
             desc=self.cmd_ACE_DISABLE_FEED_ASSIST_help)
-        self.gcode.register_command(
+        self._register_unit_command(
             'ACE_FEED', self.cmd_ACE_FEED,
             desc=self.cmd_ACE_FEED_help)
-        self.gcode.register_command(
+        self._register_unit_command(
             'ACE_RETRACT', self.cmd_ACE_RETRACT,
             desc=self.cmd_ACE_RETRACT_help)
-        self.gcode.register_command(
-            'ACE_REJECT_TOOL', self.cmd_ACE_REJECT_TOOL,
-            desc=self.cmd_ACE_REJECT_TOOL_help)
-        self.gcode.register_command(
-            'ACE_CHANGE_TOOL', self.cmd_ACE_CHANGE_TOOL,
-            desc=self.cmd_ACE_CHANGE_TOOL_help)
-        self.gcode.register_command(
-            'ACE_FILAMENT_STATUS', self.cmd_ACE_FILAMENT_STATUS,
-            desc=self.cmd_ACE_FILAMENT_STATUS_help)
-        self.gcode.register_command(
-            'ACE_CLEAR_ALL_STATUS', self.cmd_ACE_CLEAR_ALL_STATUS,
-            desc=self.cmd_ACE_CLEAR_ALL_STATUS_help)
-        self.gcode.register_command(
+        self._register_unit_command(
             'ACE_DEBUG', self.cmd_ACE_DEBUG,
             desc=self.cmd_ACE_DEBUG_help)
+        self._register_unit_command(
+            'ACE_WAIT_READY', self.cmd_ACE_WAIT_READY,
+            desc=self.cmd_ACE_WAIT_READY_help)
+        self._register_unit_command(
+            'ACE_TOOLCHANGE_STATS', self.cmd_ACE_TOOLCHANGE_STATS,
+            desc=self.cmd_ACE_TOOLCHANGE_STATS_help)
+        self._register_unit_command(
+            'ACE_DUMP_TRACE', self.cmd_ACE_DUMP_TRACE,
+            desc=self.cmd_ACE_DUMP_TRACE_help)
+        self._register_unit_command(
+            'ACE_CAPTURE', self.cmd_ACE_CAPTURE,
+            desc=self.cmd_ACE_CAPTURE_help)
+
+    def _register_unit_command(self, cmd, func, desc):
+        self.gcode.register_mux_command(cmd, 'ACE', self._name, func, desc=desc)
+        if self._name == 'ace':
+            self.gcode.register_mux_command(cmd, 'ACE', None, func, desc=desc)
 
     def _handle_ready(self):
         self.toolhead = self.printer.lookup_object('toolhead')
 
         logging.info('ACE: Connecting to ' + self.serial_name)
 
-        self._request_id = 0
+        self.serial_timer = None
         self._connected = False
         self._serial = None
-        while not self._connected:
-            self._reconnect_serial()
-            self.reactor.pause(0.5)
-
-        if not self._connected:
-            raise ValueError('ACE: Failed to connect to ' + self.serial_name)
+        self._serial_fd = None
 
-        logging.info('ACE: Connected to ' + self.serial_name)
+        # Spread the units' polls over the interval instead of firing them together
+        units = self.tools.units
+        self._poll_offset = self.poll_interval * units.index(self) / len(units)
 
-        self._queue = PeekableQueue()
+        # Nothing here waits for the unit, the serial timer connects in the
+        # background and keeps reconnecting, Klipper is ready either way
+        self._queue = AceRequestQueue()
+        self._next_reconnect = 0.
         self.serial_timer = self.reactor.register_timer(self._serial_read_write, self.reactor.NOW)
 
-        self._main_queue = queue.Queue()
-        self.main_timer = self.reactor.register_timer(self._main_eval, self.reactor.NOW)
-
-        def info_callback(self, response):
-            res = response['result']
-            self.gcode.respond_info('Connected ' + res['model'] + ' ' + res['firmware'])
-        self.send_request(request = {'method': 'get_info'}, callback = info_callback)
-
+        self._main_queue = collections.deque()
+        self.main_timer = self.reactor.register_timer(self._main_eval, self.reactor.NEVER)
 
     def _handle_disconnect(self):
         logging.info('ACE: Closing connection to ' + self.serial_name)
-        self._serial.close()
-        self._connected = False
+        self._stop_capture()
+        self._close_serial()
 
         self._main_queue = None
         self.reactor.unregister_timer(self.main_timer)
@@ -169,56 +1071,52 @@ class DuckAce:
         self._queue = None
         self.reactor.unregister_timer(self.serial_timer)
 
-    def _calc_crc(self, buffer):
-        _crc = 0xffff
-        for byte in buffer:
-            data = byte
-            data ^= _crc & 0xff
-            data ^= (data & 0x0f) << 4
-            _crc = ((data << 8) | (_crc >> 8)) ^ (data >> 4) ^ (data << 3)
-        return _crc
-
-    def _update_and_get_request_id(self):
-        if self._request_id >= 16382:
-            self._request_id = 0
-        else:
-            self._request_id += 1
-
-        return self._request_id
-
-
     def _write_serial(self, request):
-        if not 'id' in request:
-            request['id'] = self._update_and_get_request_id()
-
-        payload = json.dumps(request)
-        payload = bytes(payload, 'utf-8')
+        payload = self._protocol.request_payload(request)
 
-        data = bytes([0xFF, 0xAA])
-        data += struct.pack('@H', len(payload))
-        data += payload
-        data += struct.pack('@H', self._calc_crc(payload))
-        data += bytes([0xFE])
+        if self.log_level >= LOG_COMMANDS:
+            logging.info(f'[ACE] >>> {request}')
 
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        logging.info(f'[ACE] {now} >>> {request}')
+        return self._write_payload(payload, request['id'], request.get('method'))
 
+    def _write_payload(self, payload, id=None, method=None):
+        self._trace.record(ace_trace.TX, id, method, payload)
+        data = self._protocol.encode(payload)
         try:
+            # Bounded by write_timeout, a stalled device can't hold up the reactor
             self._serial.write(data)
         except Exception as e:
             self.gcode.respond_info(f'[ACE] serial write exception {e}')
             return False
 
+        if self._capture is not None:
+            self._capture.write(ace_capture.TX, data)
+
         return True
 
 
+    def _dispatch_main(self, task):
+        # Runs task from the main timer as soon as the reactor gets to it, in order
+        if self._main_queue is None:
+            return
+        self._main_queue.append((self.reactor.monotonic(), task))
+        self.reactor.update_timer(self.main_timer, self.reactor.NOW)
+
     def _main_eval(self, eventtime):
-        while not self._main_queue.empty():
-            task = self._main_queue.get_nowait()
-            if task is not None:
+        while self._main_queue:
+            queued_at, task = self._main_queue.popleft()
+            self._main_latency = self.reactor.monotonic() - queued_at
+            self._main_latency_max = max(self._main_latency_max, self._main_latency)
+            try:
                 task()
+            except Exception as e:
+                # Keep the dispatcher alive and make the failure visible
+                logging.exception('[ACE] main task error')
+                self._main_errors += 1
+                self._main_last_error = str(e)
+                self.gcode.respond_info(f'[ACE] {e}')
 
-        return eventtime + 0.25
+        return self.reactor.NEVER
 
     def _reconnect_serial(self):
         if self._connected:
@@ -226,164 +1124,676 @@ class DuckAce:
             return True
 
         try:
-            if self._serial != None and self._serial.isOpen():
-                self._serial.close()
-                self._connected = False
+            self._close_serial()
 
+            # Non-blocking reads, the reactor only calls us back once the port is readable
             self._serial = serial.Serial(port=self.serial_name,
-                                        baudrate=self.baud)
+                                        baudrate=self.baud,
+                                        timeout=0,
+                                        write_timeout=self.write_timeout)
             if self._serial.isOpen():
                 self._connected = True
-
-                if self._feed_assist_index != -1:
-                    self._enable_feed_assist(self._feed_assist_index)
-                self.gcode.respond_info('[ACE] Reconnected successfully.')
+                self._serial_fd = self.reactor.register_fd(self._serial.fileno(), self._handle_serial_readable)
+                self._protocol.decoder.reset()
+                self._heartbeat_id = None
+                self._missed_heartbeats = 0
                 return True
         except Exception as e:
             logging.warning(f'[ACE] reconnect error: {e}')
 
         return False
 
-    def _send_heartbeat(self, id):
-        def callback(self, response):
-            if response is not None:
-                self._info = response['result']
-
-                if self._park_in_progress and self._info['status'] == 'ready':
-                    new_assist_count = self._info['feed_assist_count']
-                    if new_assist_count > self._last_assist_count:
-                        self._last_assist_count = new_assist_count
-                        self.dwell(0.7, True) # 0.68 + small room 0.02 for response
-                        self._assist_hit_count = 0
-                    elif self._assist_hit_count < self.park_hit_count:
-                        self._assist_hit_count += 1
-                        self.dwell(0.7, True)
-                    else:
-                        self._assist_hit_count = 0
-                        self._park_in_progress = False
-                        logging.info('ACE: Parked to toolhead with assist count: ' + str(self._last_assist_count))
-
-                        if self._park_is_toolchange:
-                            self._park_is_toolchange = False
-                            def main_callback():
-                                self.gcode.run_script_from_command('_ACE_POST_TOOLCHANGE FROM=' + str(self._park_previous_tool) + ' TO=' + str(self._park_index))
-                            self._main_queue.put(main_callback)
-                        else:
-                            self.send_request(request = {'method': 'stop_feed_assist', 'params': {'index': self._park_index}}, callback=None)
-
-        self._callback_map[id] = callback
-        if not self._write_serial({'id': id, 'method': 'get_status'}):
-            return False
-
-        return True
-
-    def _reader(self):
-        data = None
+    def _connect_step(self, eventtime):
+        # Serial timer while disconnected, returns the next waketime
+        for task in self._queue.expire(eventtime):
+            self._expired += 1
+            self._fail_request(task, 'expired')
+
+        if not os.path.exists(self.serial_name):
+            # Unplugged, a stat is cheap enough to notice it coming back right away
+            self._path_present = False
+            return eventtime + self.reconnect_check_interval
+        if not self._path_present:
+            self._path_present = True
+            self._next_reconnect = eventtime
+            self._reconnect_delay = self.reconnect_min_delay
+        if eventtime < self._next_reconnect:
+            return min(self._next_reconnect, eventtime + self.reconnect_check_interval)
+
+        if not self._reconnect_serial():
+            # The path is there but the port won't open yet (udev, permissions, firmware boot)
+            self._next_reconnect = eventtime + self._reconnect_delay
+            self._reconnect_delay = min(self._reconnect_delay * 2, self.reconnect_max_delay)
+            return min(self._next_reconnect, eventtime + self.reconnect_check_interval)
 
-        for i in range(0, 2):
+        logging.info('ACE: Connected to ' + self.serial_name)
+        if self._capture is not None:
+            self._capture.write(ace_capture.LINK_UP, b'')
+        self._reconnect_delay = self.reconnect_min_delay
+        self._resync(eventtime)
+        return self.reactor.NOW
+
+    def _resync(self, eventtime):
+        # Info first, a status poll straight away, then feed assist as it was;
+        # requests queued or replayed from before the drop follow in order
+        def info_callback(self, response):
+            res = response['result']
+            self.gcode.respond_info('Connected ' + res['model'] + ' ' + res['firmware'])
+        self.send_request(request = {'method': 'get_info'}, callback = info_callback, priority = 0)
+        self._next_heartbeat = eventtime + self._poll_offset
+        self._poll_offset = 0.
+
+        index = self._feed_assist_index
+        if index != -1 and not self._queue.has_pending(('feed_assist', index)):
+            self._enable_feed_assist(index, wait=False)
+
+    def _handle_link_lost(self, eventtime, reason):
+        self._trace_anomaly('link_lost', detail=reason)
+        if self._capture is not None:
+            self._capture.write(ace_capture.LINK_DOWN, reason.encode('utf-8'))
+        self._close_serial()
+        self._disconnects += 1
+        self._heartbeat_id = None
+
+        # Unanswered requests go back in front of the queued ones, except
+        # movements which fail so whoever waits on them finds out
+        inflight = sorted(self._protocol.reset(), key=lambda task: task.sent_time or 0.)
+        pending = self._queue.drain()
+        for task in inflight:
+            if not ace_protocol.may_resend(task.request):
+                self._fail_request(task, 'disconnected')
+            else:
+                task.sent_time = None
+                self._queue.put(task)
+        for task in pending:
+            self._queue.put(task)
+
+        self._path_present = os.path.exists(self.serial_name)
+        self._next_reconnect = eventtime
+        self._reconnect_delay = self.reconnect_min_delay
+        self.gcode.respond_info(f'[ACE] {self.serial_name} lost ({reason}), reconnecting')
+
+    def _close_serial(self):
+        if self._serial_fd is not None:
+            self.reactor.unregister_fd(self._serial_fd)
+            self._serial_fd = None
+
+        if self._serial != None and self._serial.isOpen():
             try:
-                data = self._serial.read_until(expected=bytes([0xFE]), size=4096)
+                self._serial.close()
             except Exception as e:
-                self.gcode.respond_info(f'[ACE] read exception {e}')
-                return None
+                logging.warning(f'[ACE] close error: {e}')
 
-            if None != data and len(data) >= 7:
-                break
+        self._connected = False
+        self._info_live = False
 
-        if None == data or len(data) < 7:
-            logging.info(f'[ACE] Read Too short')
-            return None
+    def _handle_serial_readable(self, eventtime):
+        if not self._reader():
+            self._handle_link_lost(eventtime, 'read failed')
+            if self.serial_timer is not None:
+                self.reactor.update_timer(self.serial_timer, self.reactor.NOW)
 
-        if data[0:2] != b"\xFF\xAA":
-            logging.info(f'[ACE] Read invalid header')
-            return None
+    def _send_heartbeat(self, id):
+        # Pre-encoded request, only the id changes between heartbeats
+        payload = self._heartbeat_payload % id
+        if self.log_level >= LOG_FRAMES:
+            logging.info(f'[ACE] >>> {payload}')
+        return self._write_payload(payload, id, 'get_status')
+
+    def _handle_heartbeat_response(self, response):
+        if response is not None and 'result' in response:
+            self._update_info(response['result'])
+
+    def register_status_handler(self, kind, callback):
+        self._status_handlers.setdefault(kind, []).append(callback)
+
+    def unregister_status_handler(self, kind, callback):
+        handlers = self._status_handlers.get(kind, [])
+        if callback in handlers:
+            handlers.remove(callback)
+
+    def _update_info(self, info):
+        old = self._info
+        self._info = info
+        # The first answer on a link reports every slot, the defaults or what was
+        # there before the link dropped say nothing about the spools now
+        first = not self._info_live
+        self._info_live = True
+
+        events = []
+        if old.get('status') != info.get('status'):
+            events.append(StatusEvent('status', None, old.get('status'), info.get('status')))
+
+        old_dryer = old.get('dryer') or {}
+        new_dryer = info.get('dryer') or {}
+        if old_dryer.get('status') != new_dryer.get('status'):
+            events.append(StatusEvent('dryer_status', None, old_dryer.get('status'), new_dryer.get('status')))
+
+        if old.get('temp') != info.get('temp'):
+            events.append(StatusEvent('temp', None, old.get('temp'), info.get('temp')))
+
+        if old.get('feed_assist_count') != info.get('feed_assist_count'):
+            events.append(StatusEvent('feed_assist_count', None, old.get('feed_assist_count'), info.get('feed_assist_count')))
+
+        old_slots = old.get('slots') or []
+        for slot in info.get('slots') or []:
+            index = slot.get('index')
+            old_slot = old_slots[index] if index is not None and index < len(old_slots) else {}
+            if old_slot.get('status') != slot.get('status'):
+                events.append(StatusEvent('slot_status', index, old_slot.get('status'), slot.get('status')))
+            if (first or old_slot.get('sku') != slot.get('sku') or old_slot.get('type') != slot.get('type')
+                    or old_slot.get('color') != slot.get('color')):
+                events.append(StatusEvent('slot_content', index, old_slot, slot))
+
+        if events:
+            self._info_version += 1
+        events.append(StatusEvent('update', None, old, info))
+        for event in events:
+            for handler in list(self._status_handlers.get(event.kind, ())):
+                handler(event)
+
+    def _handle_slot_content(self, event):
+        self.tools.note_slot_content(self.first_tool + event.index, event.new)
+        if 0 <= event.index < SLOT_COUNT:
+            self._materials[event.index] = self.tools.resolve_material(event.new)
+
+    def _setting(self, index, option):
+        # The slot's material profile first, then [ace]
+        material = self._materials[index] if 0 <= index < SLOT_COUNT else None
+        value = getattr(material, option, None) if material is not None else None
+        return getattr(self, option) if value is None else value
+
+    def _macro_params(self, index):
+        material = self._materials[index] if 0 <= index < SLOT_COUNT else None
+        if material is None:
+            return ''
+        params = ' MATERIAL=' + material.name.replace(' ', '_')
+        if material.purge_length is not None:
+            params += f' PURGE_LENGTH={material.purge_length:g}'
+        if material.purge_temp is not None:
+            params += f' PURGE_TEMP={material.purge_temp:g}'
+        return params
+
+    def _handle_slot_status(self, event):
+        if event.old == 'ready' and event.new == 'empty':
+            self.tools.handle_runout(self.first_tool + event.index, 'slot empty')
+
+    def _start_park(self, index):
+        self._park_index = index
+        self._park_in_progress = True
+        self._park_completion = self.reactor.completion()
+        self._park_started = self.reactor.monotonic()
+        self._park_samples.clear()
+        self._last_assist_count = self._info.get('feed_assist_count', 0)
+        self._assist_hit_count = 0
+        # Sample right away, the detector needs a dense series while parking
+        self._next_heartbeat = self._park_started
+        self.reactor.update_timer(self.serial_timer, self.reactor.NOW)
+        return self._park_completion
 
-        payload_length = struct.unpack("@H", data[2:4])[0]
-        payload = data[4 : 4 + payload_length]
-        # crc_received = data[4 + payload_length : 4 + payload_length + 2]
+    def _finish_park(self):
+        self._assist_hit_count = 0
+        self._park_in_progress = False
+        logging.info('ACE: Parked to toolhead with assist count: ' + str(self._last_assist_count))
+
+        completion, self._park_completion = self._park_completion, None
+        completion.complete(True)
+
+    def _handle_park_assist_count(self, event):
+        if self.park_detection != 'legacy':
+            return
+        if self._park_in_progress and self._info['status'] == 'ready' and event.new > self._last_assist_count:
+            self._last_assist_count = event.new
+            self.dwell(0.7, True) # 0.68 + small room 0.02 for response
+            self._assist_hit_count = 0
 
-        # calculated_crc = self._calc_crc(payload)
-        # if calculated_crc != crc_received:
-        #     logging.info(f'[ACE] Read invalid CRC')
-        #     return None
+    def _handle_park_update(self, event):
+        if not self._park_in_progress or event.new['status'] != 'ready':
+            return
+        if self.park_detection != 'legacy':
+            self._detect_park(event.new)
+            return
+        if event.old.get('feed_assist_count') != event.new.get('feed_assist_count'):
+            return
 
+        if self._assist_hit_count < self.park_hit_count:
+            self._assist_hit_count += 1
+            self.dwell(0.7, True)
+        else:
+            self._finish_park()
+
+    def _detect_park(self, info):
+        # Parked once the assist counter (and optionally cont_assist_time) has
+        # stopped advancing over the last park_settle_time seconds
+        now = self.reactor.monotonic()
+        samples = self._park_samples
+        samples.append((now, info.get('feed_assist_count', 0), info.get('cont_assist_time', 0.)))
+        while len(samples) > 2 and now - samples[1][0] >= self.park_settle_time:
+            samples.popleft()
+        self._last_assist_count = samples[-1][1]
+
+        elapsed = now - samples[0][0]
+        if elapsed < self.park_settle_time or now - self._park_started < self.park_settle_time:
+            return
+        if (samples[-1][1] - samples[0][1]) / elapsed > self.park_count_rate:
+            return
+        if (self.park_assist_time_rate is not None
+                and (samples[-1][2] - samples[0][2]) / elapsed > self.park_assist_time_rate):
+            return
+        if self.park_confirm_sensor and not self._sensor_present(self.park_confirm_sensor):
+            return
+
+        logging.info(f'ACE: park detected {now - self._park_started:.2f}s after start')
+        self._finish_park()
+
+    def _reader(self):
         try:
-            json_str = payload.decode("utf-8")
-            ret = json.loads(json_str)
+            # One bounded read per wakeup, a readable port that returns nothing has gone away
+            data = self._serial.read(4096)
         except Exception as e:
+            self.gcode.respond_info(f'[ACE] read exception {e}')
+            return False
+
+        self._handle_rx(data)
+        return True
+
+    def _handle_rx(self, data):
+        # Everything received goes through here, replays of a capture included
+        if self._capture is not None:
+            self._capture.write(ace_capture.RX, data)
+        crc_errors = self._protocol.crc_errors
+        for payload, response, task in self._protocol.receive(data):
+            self._handle_response(payload, response, task)
+        if self._protocol.crc_errors != crc_errors:
+            logging.info(f'[ACE] Read invalid CRC')
+            self._trace_anomaly('crc_error', detail=self._protocol.crc_errors - crc_errors)
+
+    def _handle_response(self, payload, ret, task):
+        if ret is None:
             logging.info(f'[ACE] Read invalid JSON')
+            self._trace_anomaly('invalid_json', detail=bytes(payload))
             return None
 
-        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        logging.info(f'[ACE] {now} <<< {ret}')
-        id = ret['id']
-        if id in self._callback_map:
-            callback = self._callback_map.pop(id)
-            if callback != None:
+        id = ret.get('id')
+        if task is not None:
+            self._trace.record(ace_trace.RX, id, task.request.get('method'), bytes(payload))
+            if self.log_level >= LOG_COMMANDS:
+                logging.info(f'[ACE] <<< {ret}')
+        else:
+            self._trace.record(ace_trace.RX, id, 'get_status' if id == self._heartbeat_id else None, bytes(payload))
+            if self.log_level >= LOG_FRAMES:
+                logging.info(f'[ACE] <<< {ret}')
+        callback = None
+        if task is not None:
+            callback = task.callback
+            if task.sent_time is not None:
+                self._profiler.record('serial', task.request.get('method'), self.reactor.monotonic() - task.sent_time)
+        elif id == self._heartbeat_id:
+            callback = DuckAce._handle_heartbeat_response
+            self._heartbeat_id = None
+            self._missed_heartbeats = 0
+            self._profiler.record('serial', 'get_status', self.reactor.monotonic() - self._heartbeat_sent)
+
+        if callback is not None:
+            try:
                 callback(self = self, response = ret)
+            except Exception as e:
+                logging.exception('[ACE] response callback error')
+                self.gcode.respond_info(f'[ACE] {e}')
+
+        if task is not None:
+            task.complete(ret)
 
         return id
 
-    def _writer(self):
-        id = self._update_and_get_request_id()
+    def _trace_anomaly(self, kind, id=None, detail=None, dump=True):
+        self._trace.record(ace_trace.EVENT, id, kind, detail)
+        if not dump or not self.trace_dump_on_error or not self.trace_size:
+            return
+        eventtime = self.reactor.monotonic()
+        if self._last_trace_dump is not None and eventtime - self._last_trace_dump < TRACE_DUMP_INTERVAL:
+            return
+        self._last_trace_dump = eventtime
+        path = self._debug_path('trace', 'log')
+        self._trace.dump(path, f'{self._name} {self.serial_name} {kind}')
+        logging.info(f'[ACE] {kind}, trace written to {path}')
+
+    def _debug_path(self, kind, extension):
+        directory = self.trace_dir
+        if directory is None:
+            log_file = self.printer.get_start_args().get('log_file')
+            directory = os.path.dirname(log_file) if log_file else '/tmp'
+        name = self._name.replace(' ', '_')
+        return os.path.join(os.path.expanduser(directory),
+                            f'{name}_{kind}_{datetime.now().strftime("%Y%m%d-%H%M%S")}.{extension}')
+
+    def _start_capture(self, path):
+        meta = {
+            'name': self._name,
+            'serial': self.serial_name,
+            'first_tool': self.first_tool,
+            'started': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+            'options': self._config_options,
+        }
+        self._capture = ace_capture.AceCaptureWriter(path, meta, self.reactor.monotonic)
+        if self._connected:
+            self._capture.write(ace_capture.LINK_UP, b'')
+
+    def _stop_capture(self):
+        capture, self._capture = self._capture, None
+        if capture is not None:
+            capture.close()
+        return capture
+
+    def _fail_request(self, task, reason):
+        if task.on_error is not None:
+            try:
+                task.on_error(self = self, task = task, reason = reason)
+            except Exception:
+                logging.exception('[ACE] request error callback failed')
+        task.complete(None)
+
+    def _expire_queued(self, eventtime):
+        for task in self._queue.expire(eventtime):
+            self._expired += 1
+            self._fail_request(task, 'expired')
+
+    def _writer(self, eventtime):
+        self._expire_queued(eventtime)
 
-        if not self._queue.empty():
+        # User requests fill the in-flight window first, the heartbeat never holds them back
+        while len(self._inflight) < self.max_inflight and not self._queue.empty():
             task = self._queue.peek()
-            if task is not None:
-                task[0]['id'] = id
-                self._callback_map[id] = task[1]
+            id = self._protocol.next_id()
+            task.request['id'] = id
 
-                if not self._write_serial(task[0]):
-                    if not task[2]:
-                        # Not Retry
-                        self._queue.get()
+            if not self._write_serial(task.request):
+                task.retries += 1
+                if not task.with_retry or task.retries > self.request_retries:
+                    # Not Retry
+                    self._queue.get()
+                    self._fail_request(task, 'write failed')
 
-                    return None
+                return False
 
-                self._queue.get()
+            self._queue.get()
+            task.sent_time = eventtime
+            task.deadline = eventtime + self.request_timeout
+            self._protocol.expect(id, task)
 
-        else:
+        if self._heartbeat_id is None and eventtime >= self._next_heartbeat:
+            id = self._protocol.next_id()
             if not self._send_heartbeat(id):
-                return None
+                return False
 
-        return id
+            self._heartbeat_id = id
+            self._heartbeat_sent = eventtime
+            self._heartbeat_deadline = eventtime + self.request_timeout
+            self._current_poll_interval = self._heartbeat_interval(eventtime)
+            self._next_heartbeat = eventtime + self._current_poll_interval
 
-    def _serial_read_write(self, eventtime):
-        if self._connected:
-            send_id = self._writer()
-            if None == send_id:
-                self._connected = False
-                return eventtime + 1
-
-            read_id = self._reader()
-            if read_id != send_id:
-                self._connected = False
-                return eventtime + 1
-        else:
-            self._reconnect_serial()
-            return eventtime + 1
+        return True
+
+    def _check_timeouts(self, eventtime):
+        for id, task in list(self._inflight.items()):
+            expired = task.expires is not None and eventtime >= task.expires
+            if eventtime < task.deadline and not expired:
+                continue
+
+            if not expired and task.with_retry and task.retries < self.request_retries:
+                task.retries += 1
+                task.deadline = eventtime + self.request_timeout
+                if not ace_protocol.may_resend(task.request):
+                    # The unit may be moving already, only wait longer for the answer
+                    logging.info(f'[ACE] No answer yet to request {id}, waiting')
+                    self._trace_anomaly('late', id, task.retries, dump=False)
+                    continue
+                logging.info(f'[ACE] Retry {task.retries} for request {id}')
+                self._trace_anomaly('retry', id, task.retries, dump=False)
+                if not self._write_serial(task.request):
+                    return False
+                continue
+
+            self._protocol.cancel(id)
+            self._timeouts += 1
+            self.gcode.respond_info(f'[ACE] Request {id} {task.request.get("method")} timed out')
+            self._trace_anomaly('timeout', id, task.request.get('method'))
+            self._fail_request(task, 'expired' if expired else 'timeout')
+
+        if self._heartbeat_id is not None and eventtime >= self._heartbeat_deadline:
+            self._heartbeat_id = None
+            self._missed_heartbeats += 1
+            logging.info(f'[ACE] Missed heartbeat {self._missed_heartbeats}')
+            self._trace_anomaly('missed_heartbeat', detail=self._missed_heartbeats, dump=False)
+            if self._missed_heartbeats >= self.max_missed_heartbeats:
+                self._missed_heartbeats = 0
+                return False
+
+        return True
 
+    def _heartbeat_interval(self, eventtime):
         if self._park_in_progress:
-            next_time = 0.68
-        else:
-            next_time = 0.25
-        return eventtime + next_time
+            if self.park_detection == 'legacy':
+                return 0.68
+            self._last_activity = eventtime
+            return self.poll_interval_active
+        # Fast while the unit is moving filament, slow once it has been idle for a while
+        if eventtime < self._active_until or self._info.get('status') != 'ready':
+            self._last_activity = eventtime
+            return self.poll_interval_active
+        dryer = self._info.get('dryer') or {}
+        if (dryer.get('status', 'stop') == 'stop' and self._feed_assist_index == -1
+                and eventtime - self._last_activity >= self.idle_timeout):
+            return self.poll_interval_idle
+        return self.poll_interval
+
+    def _mark_active(self, duration):
+        eventtime = self.reactor.monotonic()
+        self._last_activity = eventtime
+        self._active_until = max(self._active_until, eventtime + duration)
+        self._next_heartbeat = min(self._next_heartbeat, eventtime + self.poll_interval_active)
+
+    def _next_wakeup(self, eventtime):
+        next_time = self._next_heartbeat
+        if self._heartbeat_id is not None:
+            next_time = min(next_time, self._heartbeat_deadline)
+        for task in self._inflight.values():
+            next_time = min(next_time, task.deadline)
+            if task.expires is not None:
+                next_time = min(next_time, task.expires)
+        expiry = self._queue.next_expiry()
+        if expiry is not None:
+            next_time = min(next_time, expiry)
+        return next_time
 
-    def wait_ace_ready(self):
-        while self._info['status'] != 'ready':
-            self.dwell(delay=0.5)
+    def _serial_read_write(self, eventtime):
+        if not self._connected:
+            # Requests with a deadline run out while the unit is away too
+            self._expire_queued(eventtime)
+            waketime = self._connect_step(eventtime)
+            expiry = self._queue.next_expiry()
+            return waketime if expiry is None else min(waketime, expiry)
+
+        if not self._check_timeouts(eventtime):
+            self._handle_link_lost(eventtime, 'no response')
+            return self._connect_step(eventtime)
+        if not self._writer(eventtime):
+            self._handle_link_lost(eventtime, 'write failed')
+            return self._connect_step(eventtime)
+
+        return self._next_wakeup(eventtime)
+
+    def wait_ace_ready(self, timeout=None):
+        return self.wait_for_status(lambda info: info.get('status') == 'ready', timeout)
+
+    def wait_for_status(self, predicate, timeout=None):
+        # predicate(info) is checked against the current state and then on every heartbeat.
+        # Without a timeout a unit that is offline fails at once, it may never answer
+        if self._connected and self._info_live and predicate(self._info):
+            return True
+        if timeout is None and not self._connected:
+            raise self.gcode.error(f'ACE: {self.serial_name} is not connected')
 
+        completion = self.reactor.completion()
+        def handler(event):
+            if predicate(event.new):
+                completion.complete(True)
 
-    def send_request(self, request, callback, with_retry=True):
-        self._queue.put([request, callback, with_retry])
+        waketime = self.reactor.NEVER
+        if timeout is not None:
+            waketime = self.reactor.monotonic() + timeout
 
+        self.register_status_handler('update', handler)
+        try:
+            return completion.wait(waketime) is not None
+        finally:
+            self.unregister_status_handler('update', handler)
+
+    def wait_request(self, task, expected=None, timeout=None):
+        # Wait for the ACE to acknowledge a request and, when it starts a
+        # movement (expected is its nominal duration), for it to finish
+        if timeout is None:
+            timeout = self.request_timeout * (self.request_retries + 1) + 1.
+            if expected is not None:
+                timeout += expected * 1.5 + 5.
+        deadline = self.reactor.monotonic() + timeout
+
+        method = task.request.get('method')
+        response = task.wait(deadline)
+        if response is None:
+            raise self.gcode.error(f'ACE Error: no response to {method}')
+        if response.get('code', 0) != 0:
+            raise self.gcode.error('ACE Error: ' + str(response.get('msg')))
+
+        if expected is not None and not self._wait_ready_after(task.sent_time, expected, deadline):
+            raise self.gcode.error(f'ACE Error: {method} did not finish in time')
+
+        return response
+
+    def _wait_ready_after(self, since, expected, deadline):
+        # A ready status only proves completion once the unit was seen busy, or
+        # after the nominal duration; the first heartbeat may predate the command
+        state = {'busy': False}
+        completion = self.reactor.completion()
+        def handler(event):
+            if event.new.get('status') != 'ready':
+                state['busy'] = True
+            elif state['busy'] or self.reactor.monotonic() >= since + expected:
+                completion.complete(True)
+
+        self.register_status_handler('update', handler)
+        try:
+            return completion.wait(deadline) is not None
+        finally:
+            self.unregister_status_handler('update', handler)
+
+    def send_request(self, request, callback, with_retry=True, priority=None, deadline=None, on_error=None):
+        # deadline: seconds from now after which the request is dropped and on_error called
+        params = request.get('params') or {}
+        if 'length' in params and params.get('speed'):
+            self._mark_active(params['length'] / params['speed'] + 1.)
+        else:
+            self._mark_active(1.)
+
+        expires = None
+        if deadline is not None:
+            expires = self.reactor.monotonic() + deadline
+        task = AceRequest(self.reactor, request, callback, with_retry, priority, expires, on_error)
+        self._queue.put(task)
+        # Queued commands go out right away, they never wait for the heartbeat
+        self.reactor.update_timer(self.serial_timer, self.reactor.NOW)
+        return task
+
+    def _send_command(self, request, callback):
+        # Requests from console commands that nothing waits on are dropped if not
+        # answered in time, a late reconnect mustn't replay them minutes later
+        def on_error(self, task, reason):
+            self.gcode.respond_info(f'ACE Error: {task.request.get("method")} not sent ({reason})')
+        return self.send_request(request=request, callback=callback, deadline=self.command_timeout, on_error=on_error)
+
+    def get_status(self, eventtime=None):
+        # Front-ends poll this often, it is a lookup unless the heartbeat,
+        # the state store or the once a second link figures changed. The
+        # snapshot is never modified, a change builds a new one
+        if eventtime is None:
+            eventtime = self.reactor.monotonic()
+        elapsed = eventtime - self._link_rate_time
+        if elapsed >= 1.:
+            total = self._protocol.tx_bytes + self._protocol.rx_bytes
+            self._link_rate = (total - self._link_rate_bytes) / elapsed
+            self._link_rate_time = eventtime
+            self._link_rate_bytes = total
+
+        key = (self._info_version, self._feed_assist_index, self._connected,
+               self.variables.version, self._link_rate_time)
+        if key != self._status_key:
+            self._status_key = key
+            self._status = self._build_status()
+        return self._status
+
+    def _material_name(self, index):
+        material = self._materials[index] if index is not None and 0 <= index < SLOT_COUNT else None
+        return material.name if material is not None else None
+
+    def _build_status(self):
+        info = self._info
+        current_tool = self.variables.get('ace_current_index', -1)
+        current_slot = current_tool - self.first_tool
+        if current_slot < 0 or current_slot >= SLOT_COUNT:
+            current_slot = -1
+        dryer = info.get('dryer') or {}
+
+        return {
+            'status': info.get('status'),
+            'slots': tuple({
+                'index': slot.get('index'),
+                'tool': self.first_tool + slot.get('index', 0),
+                'status': slot.get('status'),
+                'sku': slot.get('sku'),
+                'type': slot.get('type'),
+                'color': tuple(slot.get('color') or ()),
+                'material': self._material_name(slot.get('index')),
+            } for slot in info.get('slots') or ()),
+            'dryer': {
+                'status': dryer.get('status'),
+                'target_temp': dryer.get('target_temp'),
+                'duration': dryer.get('duration'),
+                'remain_time': dryer.get('remain_time'),
+            },
+            'temp': info.get('temp'),
+            'feed_assist_index': self._feed_assist_index,
+            'first_tool': self.first_tool,
+            'current_tool': current_tool,
+            'current_slot': current_slot,
+            'filament_pos': self.variables.get('ace_filament_pos', 'spliter'),
+            'connected': self._connected,
+            'disconnects': self._disconnects,
+            'poll_interval': self._current_poll_interval,
+            'missed_heartbeats': self._missed_heartbeats,
+            'crc_errors': self._protocol.crc_errors,
+            'invalid_frames': self._protocol.invalid_frames,
+            'tx_bytes': self._protocol.tx_bytes,
+            'rx_bytes': self._protocol.rx_bytes,
+            'bytes_per_second': round(self._link_rate, 1),
+            'main_queue_depth': len(self._main_queue) if self._main_queue is not None else 0,
+            'main_dispatch_latency': round(self._main_latency, 4),
+            'main_dispatch_latency_max': round(self._main_latency_max, 4),
+            'main_dispatch_errors': self._main_errors,
+            'main_dispatch_last_error': self._main_last_error,
+            'queue_depth': len(self._queue) if self._queue is not None else 0,
+            'inflight': len(self._inflight),
+            'requests_coalesced': self._queue.coalesced if self._queue is not None else 0,
+            'requests_expired': self._expired,
+            'requests_timed_out': self._timeouts,
+            'toolchange_stats': self._profiler.get_stats(),
+        }
 
     def dwell(self, delay = 1., on_main = False):
         def main_callback():
             self.toolhead.dwell(delay)
 
         if on_main:
-            self._main_queue.put(main_callback)
+            self._dispatch_main(main_callback)
         else:
             main_callback()
 
@@ -393,117 +1803,418 @@ class DuckAce:
         self.toolhead.move(pos, speed)
         return pos[3]
 
-    def _create_mmu_sensor(self, config, pin, name):
-        section = 'filament_switch_sensor %s' % name
-        config.fileconfig.add_section(section)
-        config.fileconfig.set(section, 'switch_pin', pin)
-        config.fileconfig.set(section, 'pause_on_runout', 'False')
-        fs = self.printer.load_object(config, section)
+    def register_sensor_handler(self, name, callback):
+        self.tools.register_sensor_handler(name, callback)
 
-    def _feed(self, index, length, speed):
-        def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise ValueError('ACE Error: ' + response['msg'])
+    def unregister_sensor_handler(self, name, callback):
+        self.tools.unregister_sensor_handler(name, callback)
 
-        self.send_request(request = {'method': 'feed_filament', 'params': {'index': index, 'length': length, 'speed': speed}}, callback = callback)
-        self.dwell(delay = (length / speed) + 0.1)
+    def _sensor_present(self, name):
+        return self.tools.sensor_present(name)
 
-    def _retract(self, index, length, speed):
-        def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise ValueError('ACE Error: ' + response['msg'])
+    def _wait_sensor(self, name, present, timeout):
+        if self._sensor_present(name) == present:
+            return True
 
-        self.send_request(
+        completion = self.reactor.completion()
+        def handler(eventtime, state):
+            if state == present:
+                completion.complete(eventtime)
+
+        self.register_sensor_handler(name, handler)
+        try:
+            return completion.wait(self.reactor.monotonic() + timeout) is not None
+        finally:
+            self.unregister_sensor_handler(name, handler)
+
+    def _approach_sensor(self, name, max_length, speed):
+        return self._move_until_sensor(name, True, max_length, speed)
+
+    def _move_until_sensor(self, name, present, length, speed, on_start=None):
+        # Moves the extruder by up to `length` mm (negative pulls back) until
+        # sensor `name` reports `present`, returns (distance to the edge,
+        # overshoot past it) or None if the edge never came.
+        # One drip move, like a homing move: the edge ends it within a drip
+        # segment and the rest is dropped, the stepper tells where it stopped.
+        # on_start(eventtime) is told when the move will start moving
+        if self._sensor_present(name) == present:
+            return 0., 0.
+
+        mcu = self.printer.lookup_object('mcu')
+        extruder = self.toolhead.get_extruder()
+        stepper = extruder.extruder_stepper.stepper
+        trigger = {}
+        completion = self.reactor.completion()
+        def handler(eventtime, state):
+            if state == present and 'time' not in trigger:
+                trigger['time'] = eventtime
+                completion.complete(eventtime)
+
+        self.toolhead.flush_step_generation()
+        pos = self.toolhead.get_position()
+        start = stepper.get_commanded_position()
+        target = pos[3] + length
+        if on_start is not None:
+            now = self.reactor.monotonic()
+            start_time = self.toolhead.get_last_move_time() + getattr(self.toolhead, 'kin_flush_delay', 0.)
+            on_start(now + start_time - mcu.estimated_print_time(now))
+
+        self.register_sensor_handler(name, handler)
+        try:
+            self.toolhead.drip_move(pos[:3] + [target] + pos[4:], speed, completion)
+            if 'time' not in trigger:
+                # The edge may still come during the last drip segment
+                self.toolhead.wait_moves()
+        finally:
+            self.unregister_sensor_handler(name, handler)
+
+        self.toolhead.flush_step_generation()
+        stop = pos[3] + stepper.get_commanded_position() - start
+        if abs(stop - target) > 0.001:
+            # Cut short: the extruder's queue still holds the rest of the move
+            # and the toolhead thinks it reached the target
+            import chelper
+            ffi_main, ffi_lib = chelper.get_ffi()
+            ffi_lib.trapq_finalize_moves(extruder.get_trapq(), self.reactor.NEVER, 0)
+            self.toolhead.set_position(pos[:3] + [stop] + pos[4:])
+
+        if 'time' not in trigger:
+            return None
+        trigger_time = mcu.estimated_print_time(trigger['time'])
+        edge = pos[3] + stepper.mcu_to_commanded_position(stepper.get_past_mcu_position(trigger_time)) - start
+        return abs(edge - pos[3]), abs(stop - edge)
+
+    def _feed(self, index, length, speed=None):
+        if speed is None:
+            speed = self._setting(index, 'feed_speed')
+        self._wait_hub_retract()
+        self._wait_staging()
+        task = self.send_request(request = {'method': 'feed_filament', 'params': {'index': index, 'length': length, 'speed': speed}}, callback = None)
+        self.wait_request(task, expected = length / speed)
+
+    def _retract(self, index, length, speed=None):
+        if speed is None:
+            speed = self._setting(index, 'retract_speed')
+        self._wait_hub_retract()
+        self._wait_staging()
+        task = self.send_request(
             request={'method': 'unwind_filament', 'params': {'index': index, 'length': length, 'speed': speed}},
-            callback=callback)
-        self.dwell(delay=(length / speed) + 0.1)
+            callback=None)
+        self.wait_request(task, expected = length / speed)
 
-    def _enable_feed_assist(self, index):
+    def _enable_feed_assist(self, index, wait=True):
         def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise ValueError('ACE Error: ' + response['msg'])
-            else:
+            if response.get('code', 0) == 0:
                 self._feed_assist_index = index
                 # self.gcode.respond_info(str(response))
 
-        self.send_request(request = {'method': 'start_feed_assist', 'params': {'index': index}}, callback = callback)
-        self.dwell(delay = 0.7)
+        task = self.send_request(request = {'method': 'start_feed_assist', 'params': {'index': index}}, callback = callback)
+        if wait:
+            self.wait_request(task)
 
     def _disable_feed_assist(self, index):
         def callback(self, response):
-            if 'code' in response and response['code'] != 0:
-                raise self.gcode.error('ACE Error: ' + response['msg'])
+            if response.get('code', 0) == 0:
+                self._feed_assist_index = -1
+                self.gcode.respond_info('Disabled ACE feed assist')
+
+        task = self.send_request(request = {'method': 'stop_feed_assist', 'params': {'index': index}}, callback = callback)
+        self.wait_request(task)
+
+    def _load_tool(self, index):
+        self._wait_hub_retract()
+        self._wait_staging()
+        tool = self.first_tool + index
+        staged = self.tools.get_staged(tool)
+        self.tools.set_staged(tool, 0)
+        with self._profiler.measure(index, 'feed'):
+            # A staged tool only has the rest of the bowden left to cover
+            length = self._load_length(index) - staged
+            if length > 0:
+                self._feed(index, length, self._setting(index, 'retract_speed'))
+            self.variables['ace_filament_pos'] = 'bowden'
+            self.wait_ace_ready()
 
-            self._feed_assist_index = -1
-            self.gcode.respond_info('Disabled ACE feed assist')
+        self._park_to_toolhead(index)
+
+    def _calibration(self, index):
+        return self.tools.get_calibration(self.first_tool + index)
+
+    def _load_length(self, index):
+        # ACE feed from the rest position to just short of the extruder sensor
+        extruder_length = self._calibration(index).get('extruder')
+        if extruder_length:
+            return max(0., extruder_length - self.calibration_margin)
+        return self._setting(index, 'toolchange_retract_length') - 5
+
+    def _unload_length(self, index):
+        # Back to the rest position the slot was calibrated from
+        extruder_length = self._calibration(index).get('extruder')
+        if extruder_length:
+            return extruder_length
+        return self._setting(index, 'toolchange_retract_length')
+
+    def _approach_toolhead(self, index):
+        # Calibrated: most of the way at toolhead_fast_speed, then the last
+        # calibration_margin around the sensor at the approach speed
+        toolhead_length = self._calibration(index).get('toolhead')
+        approach_speed = self._setting(index, 'toolhead_approach_speed')
+        fast = toolhead_length - self.calibration_margin if toolhead_length else 0.
+        if fast <= 0:
+            return self._approach_sensor(self.toolhead_sensor, self.toolhead_approach_length, approach_speed)
+
+        approach = self._approach_sensor(self.toolhead_sensor, fast, self._setting(index, 'toolhead_fast_speed'))
+        if approach is not None:
+            return approach
+        approach = self._approach_sensor(self.toolhead_sensor, self.toolhead_approach_length, approach_speed)
+        if approach is None:
+            return None
+        return fast + approach[0], approach[1]
+
+    def _feed_until_sensor(self, index, max_length, speed):
+        # The ACE can't report how far it fed, the distance is taken from the
+        # time between the feed starting and the extruder sensor edge; the feed
+        # is stopped from the edge itself
+        state = {}
+        completion = self.reactor.completion()
+        def handler(eventtime, present):
+            if present and 'edge' not in state:
+                state['edge'] = eventtime
+                self.send_request(request = {'method': 'stop_feed_filament', 'params': {'index': index}}, callback = None, with_retry = False)
+                completion.complete(eventtime)
+        def started(self, response):
+            state['ack'] = self.reactor.monotonic()
+
+        self.register_sensor_handler(self.extruder_sensor, handler)
+        try:
+            task = self.send_request(
+                request={'method': 'feed_filament', 'params': {'index': index, 'length': max_length, 'speed': speed}},
+                callback=started)
+            self.wait_request(task)
+            completion.wait(self.reactor.monotonic() + max_length / speed * 1.5 + 5.)
+        finally:
+            self.unregister_sensor_handler(self.extruder_sensor, handler)
+
+        if 'edge' not in state:
+            self.send_request(request = {'method': 'stop_feed_filament', 'params': {'index': index}}, callback = None, with_retry = False)
+            raise self.gcode.error(f'ACE: extruder sensor not reached within {max_length:.0f}mm')
+
+        # The unit starts moving somewhere between sending and acknowledging
+        start = (task.sent_time + state.get('ack', task.sent_time)) / 2.
+        self.wait_ace_ready()
+        return (state['edge'] - start) * speed
 
-        self.send_request(request = {'method': 'stop_feed_assist', 'params': {'index': index}}, callback = callback)
-        self.dwell(0.3)
+    def _calibrate(self, index):
+        # Starts from the slot's rest position, where a fresh spool or an unload leaves it
+        self.gcode.respond_info(f'ACE: calibrating tool {self.first_tool + index}')
+        if self._sensor_present(self.extruder_sensor):
+            raise self.gcode.error('ACE: extruder sensor already triggered, clear the path first')
+        self._wait_hub_retract()
+        self._wait_staging()
 
-    def _save_to_disk(self):
-        self.gcode.run_script_from_command('SAVE_VARIABLE VARIABLE=ace_current_index VALUE=' + str(self.variables['ace_current_index']))
-        self.gcode.run_script_from_command(f"""SAVE_VARIABLE VARIABLE=ace_filament_pos VALUE='"{self.variables['ace_filament_pos']}"'""")
+        max_length = self.toolchange_retract_length + self.calibration_margin
+        extruder_length = self._feed_until_sensor(index, max_length, self.calibration_speed)
+        self.variables['ace_filament_pos'] = 'bowden'
 
-    def _park_to_toolhead(self, tool):
-        sensor_extruder = self.printer.lookup_object('filament_switch_sensor %s' % 'extruder_sensor', None)
-        sensor_toolhead = self.printer.lookup_object('filament_switch_sensor %s' % 'toolhead_sensor', None)
+        self._enable_feed_assist(index)
+        approach = self._approach_sensor(self.toolhead_sensor, self.toolhead_approach_length, self.toolhead_approach_speed)
+        if approach is None:
+            self._disable_feed_assist(index)
+            raise self.gcode.error('ACE: toolhead sensor not reached while calibrating')
+        self.toolhead.wait_moves()
+        self.variables['ace_filament_pos'] = 'toolhead'
 
-        self._enable_feed_assist(tool)
+        lengths = {'extruder': round(extruder_length, 1), 'toolhead': round(approach[0], 1)}
+        # Stored before unloading so the unload already returns to the rest position
+        self.tools.set_calibration(self.first_tool + index, lengths)
+        self._reject_tool(index)
+        return lengths
+
+    def _stage_tool(self, index, length):
+        # Feeds in the background like the hub retract, the print carries on
+        self._wait_hub_retract()
+        self._wait_staging()
+        length = min(length, self._load_length(index))
+        speed = self._setting(index, 'feed_speed')
+        task = self.send_request(
+            request={'method': 'feed_filament', 'params': {'index': index, 'length': length, 'speed': speed}},
+            callback=None)
+        # Recorded up front, an abort while it runs must still unwind it
+        self.tools.set_staged(self.first_tool + index, length)
+        self._staging = {'task': task, 'index': index, 'length': length, 'speed': speed}
+        self.gcode.respond_info(f'ACE: staging tool {self.first_tool + index}, {length:.0f}mm')
+
+    def _wait_staging(self):
+        staging = self._staging
+        if staging is None:
+            return
+        self._staging = None
 
-        while not bool(sensor_extruder.runout_helper.filament_present):
-            self.dwell(delay=0.1)
+        try:
+            self.wait_request(staging['task'], expected = staging['length'] / staging['speed'])
+        except self.printer.command_error as e:
+            # The feed was refused or lost, the toolchange feeds the full length
+            self.gcode.respond_info(f'ACE: staging tool {self.first_tool + staging["index"]} failed: {e}')
+            self.tools.set_staged(self.first_tool + staging['index'], 0)
+            self.wait_ace_ready()
+
+    def _unstage(self, index):
+        self._wait_staging()
+        tool = self.first_tool + index
+        length = self.tools.get_staged(tool)
+        if length <= 0:
+            return
+        self.gcode.respond_info(f'ACE: unstage tool {tool}, {length:.0f}mm')
+        self._retract(index, length)
+        self.tools.set_staged(tool, 0)
+
+    def _park_to_toolhead(self, tool):
+        with self._profiler.measure(tool, 'park'):
+            self._enable_feed_assist(tool)
+
+            if self.park_detection == 'sensor':
+                if not self._wait_sensor(self.extruder_sensor, True, self.extruder_sensor_timeout):
+                    raise self.gcode.error('ACE: Filament stuck, extruder sensor not triggered')
+            elif self._start_park(tool).wait(self.reactor.monotonic() + self.park_timeout) is None:
+                self._park_in_progress = False
+                self._park_completion = None
+                raise self.gcode.error('ACE: Filament stuck, feed assist did not settle')
 
-        if not bool(sensor_extruder.runout_helper.filament_present):
-            raise ValueError('Filament stuck ' + str(bool(sensor_extruder.runout_helper.filament_present)))
-        else:
             self.variables['ace_filament_pos'] = 'spliter'
 
-        while not bool(sensor_toolhead.runout_helper.filament_present):
-            self._extruder_move(1, 5)
+        with self._profiler.measure(tool, 'approach'):
+            approach = self._approach_toolhead(tool)
+        if approach is None:
+            raise self.gcode.error('ACE: Filament stuck, toolhead sensor not triggered')
 
         self.variables['ace_filament_pos'] = 'toolhead'
+        distance, overshoot = approach
+        logging.info(f'ACE: toolhead sensor reached after {distance:.1f}mm, overshoot {overshoot:.1f}mm')
+
+        remaining = self.toolhead_sensor_to_nozzle - overshoot
+        if self.toolhead_sensor_to_nozzle > 0 and remaining > 0:
+            self._extruder_move(remaining, self._setting(tool, 'toolhead_approach_speed'))
 
         # The nozzle should be cleaned by brushing
         self.variables['ace_filament_pos'] = 'nozzle'
 
-        if self.disable_assist_after_toolchange:
+        if self._setting(tool, 'disable_assist_after_toolchange'):
             self.send_request({"method": "stop_feed_assist", "params": {"index": tool}}, callback=None)
 
-    def _reject_tool(self, index):
-        self.gcode.respond_info(f'ACE: reject tool {index}')
-        sensor_extruder = self.printer.lookup_object('filament_switch_sensor %s' % 'extruder_sensor', None)
+    def _start_hub_retract(self, index, interrupt=False):
+        # interrupt stops a running unwind first, the ACE handles requests in order
+        if interrupt:
+            self.send_request(request = {'method': 'stop_unwind_filament', 'params': {'index': index}}, callback = None, with_retry = False)
+
+        length = self._unload_length(index)
+        speed = self._setting(index, 'retract_speed')
+        task = self.send_request(
+            request={'method': 'unwind_filament', 'params': {'index': index, 'length': length, 'speed': speed}},
+            callback=None)
+        return {'task': task, 'index': index, 'length': length, 'speed': speed,
+                'start': self.reactor.monotonic(), 'phases': []}
+
+    def _extract_from_extruder(self, index):
+        # The extruder pulls back while the ACE unwinds at the same speed, both
+        # started together. The fast hub retract is sent from the sensor edge
+        # itself, without waiting for the G-code side to notice
+        state = {}
+        extract_speed = self._setting(index, 'extract_speed')
+        def send_unwind(eventtime):
+            if 'hub' not in state:
+                state['unwind'] = self.send_request(
+                    request={'method': 'unwind_filament', 'params': {'index': index, 'length': self.extract_length, 'speed': extract_speed}},
+                    callback=None, with_retry=False)
+        def start_unwind(waketime):
+            self.reactor.register_callback(send_unwind, waketime)
+        def handler(eventtime, present):
+            if not present and 'hub' not in state:
+                state['hub'] = self._start_hub_retract(index, 'unwind' in state)
+
+        # Let the cut finish before anything pulls on the filament
+        self.toolhead.wait_moves()
+        self.register_sensor_handler(self.extruder_sensor, handler)
+        try:
+            result = self._move_until_sensor(self.extruder_sensor, False, -self.extract_length, extract_speed, on_start=start_unwind)
+        finally:
+            self.unregister_sensor_handler(self.extruder_sensor, handler)
+
+        if result is None:
+            if 'unwind' in state:
+                self.send_request(request = {'method': 'stop_unwind_filament', 'params': {'index': index}}, callback = None, with_retry = False)
+            raise self.gcode.error(f'ACE: tool {index} still in the extruder after {self.extract_length:.0f}mm')
+        if 'hub' not in state:
+            state['hub'] = self._start_hub_retract(index, 'unwind' in state)
+
+        return state['hub']
+
+    def _wait_hub_retract(self):
+        hub = self._hub_retract
+        if hub is None:
+            return
+        self._hub_retract = None
 
+        expected = hub['length'] / hub['speed']
+        try:
+            self.wait_request(hub['task'], expected = expected)
+        except self.printer.command_error as e:
+            # Firmware without stop_unwind_filament rejects the retract while still
+            # unwinding. Anything else (no answer, not finished) may have moved already
+            response = hub['task'].response
+            if response is None or response.get('code', 0) == 0:
+                raise
+            logging.info(f'ACE: hub retract rejected ({e}), retrying')
+            self.wait_ace_ready()
+            self._retract(hub['index'], hub['length'], hub['speed'])
+
+        self.variables['ace_filament_pos'] = 'spliter'
+        duration = self.reactor.monotonic() - hub['start']
+        self._profiler.record(hub['index'], 'hub_retract', duration)
+        hub['phases'].append(('hub', duration))
+        self.gcode.respond_info(f'ACE: unload tool {hub["index"]} ' + ' '.join(
+            f'{name} {duration:.2f}s' for name, duration in hub['phases']))
+
+    def _reject_tool(self, index, wait=True):
+        self.gcode.respond_info(f'ACE: reject tool {index}')
+        phases = []
+        phase_start = [self.reactor.monotonic()]
+        def end_phase(name):
+            now = self.reactor.monotonic()
+            phases.append((name, now - phase_start[0]))
+            self._profiler.record(index, name, now - phase_start[0])
+            phase_start[0] = now
+
+        self._wait_hub_retract()
+        self._wait_staging()
         self._disable_feed_assist(index)
         self.wait_ace_ready()
         if  self.variables.get('ace_filament_pos', 'spliter') == 'nozzle':
             self.gcode.respond_info(f'ACE: cut tool {index}')
             self.gcode.run_script_from_command('CUT_TIP')
             self.variables['ace_filament_pos'] = 'toolhead'
+            end_phase('cut')
 
+        hub = None
         if  self.variables.get('ace_filament_pos', 'spliter') == 'toolhead':
             self.gcode.respond_info(f'ACE: extract tool {index} out of the extruder')
-            while bool(sensor_extruder.runout_helper.filament_present):
-                self._extruder_move(-20, 5)
-                self._retract(index, 20, self.retract_speed)
-                self.dwell(1)
+            hub = self._extract_from_extruder(index)
             self.variables['ace_filament_pos'] = 'bowden'
+            end_phase('extract')
 
-        self.wait_ace_ready()
-
-        self.gcode.respond_info(f'ACE: extract tool {index} out of the hub')
-        self._retract(index, self.toolchange_retract_length, self.retract_speed)
-        self.variables['ace_filament_pos'] = 'spliter'
+        if hub is None:
+            self.gcode.respond_info(f'ACE: extract tool {index} out of the hub')
+            hub = self._start_hub_retract(index)
 
-        self.wait_ace_ready()
+        # The hub retract runs on the ACE while the toolhead carries on, callers
+        # that need the path clear wait for it with _wait_hub_retract()
+        hub['phases'] = phases
+        self._hub_retract = hub
 
         self.gcode.respond_info(f'ACE: set current index -1')
         self.variables['ace_current_index'] = -1
 
-        self._save_to_disk()
-
-    cmd_ACE_GET_CUR_INDEX_help = 'Get current tool index'
-    def cmd_ACE_GET_CUR_INDEX(self, gcmd):
-        self.gcode.respond_info('ACE Current index {}'.format(self.variables['ace_current_index']))
+        if wait:
+            self._wait_hub_retract()
 
     cmd_ACE_START_DRYING_help = 'Starts ACE Pro dryer'
     def cmd_ACE_START_DRYING(self, gcmd):
@@ -521,7 +2232,7 @@ class DuckAce:
 
             self.gcode.respond_info('Started ACE drying')
 
-        self.send_request(request = {'method': 'drying', 'params': {'temp':temperature, 'fan_speed': 7000, 'duration': duration}}, callback = callback)
+        self._send_command(request = {'method': 'drying', 'params': {'temp':temperature, 'fan_speed': 7000, 'duration': duration}}, callback = callback)
 
 
     cmd_ACE_STOP_DRYING_help = 'Stops ACE Pro dryer'
@@ -532,13 +2243,13 @@ class DuckAce:
 
             self.gcode.respond_info('Stopped ACE drying')
 
-        self.send_request(request = {'method':'drying_stop'}, callback = callback)
+        self._send_command(request = {'method':'drying_stop'}, callback = callback)
 
     cmd_ACE_ENABLE_FEED_ASSIST_help = 'Enables ACE feed assist'
     def cmd_ACE_ENABLE_FEED_ASSIST(self, gcmd):
         index = gcmd.get_int('INDEX')
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= SLOT_COUNT:
             raise gcmd.error('Wrong index')
 
         self._enable_feed_assist(index)
@@ -550,7 +2261,7 @@ class DuckAce:
         else:
             index = gcmd.get_int('INDEX')
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= SLOT_COUNT:
             raise gcmd.error('Wrong index')
 
         self._disable_feed_assist(index)
@@ -559,9 +2270,9 @@ class DuckAce:
     def cmd_ACE_FEED(self, gcmd):
         index = gcmd.get_int('INDEX')
         length = gcmd.get_int('LENGTH')
-        speed = gcmd.get_int('SPEED', self.feed_speed)
+        speed = gcmd.get_int('SPEED', self._setting(index, 'feed_speed'))
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= SLOT_COUNT:
             raise gcmd.error('Wrong index')
         if length <= 0:
             raise gcmd.error('Wrong length')
@@ -574,9 +2285,9 @@ class DuckAce:
     def cmd_ACE_RETRACT(self, gcmd):
         index = gcmd.get_int('INDEX')
         length = gcmd.get_int('LENGTH')
-        speed = gcmd.get_int('SPEED', self.retract_speed)
+        speed = gcmd.get_int('SPEED', self._setting(index, 'retract_speed'))
 
-        if index < 0 or index >= 4:
+        if index < 0 or index >= SLOT_COUNT:
             raise gcmd.error('Wrong index')
         if length <= 0:
             raise gcmd.error('Wrong length')
@@ -585,80 +2296,94 @@ class DuckAce:
 
         self._retract(index, length, speed)
 
-    cmd_ACE_CLEAR_ALL_STATUS_help = 'Clean status'
-    def cmd_ACE_CLEAR_ALL_STATUS(self, gcmd):
-        self.variables['ace_current_index'] = -1
-        self.variables['ace_filament_pos'] = 'spliter'
-        self._save_to_disk()
-
-    cmd_ACE_REJECT_TOOL_help = 'Reject tool'
-    def cmd_ACE_REJECT_TOOL(self, gcmd):
-        tool = gcmd.get_int('TOOL', -1)
-
-        if -1 == tool:
-            tool = self.variables.get('ace_current_index', -1)
-        if tool != -1:
-            self._reject_tool(tool)
-
-    cmd_ACE_CHANGE_TOOL_help = 'Changes tool'
-    def cmd_ACE_CHANGE_TOOL(self, gcmd):
-        # self.gcode.respond_info('ACE: Changing tool...')
-        tool = gcmd.get_int('TOOL')
-
-        if tool < -1 or tool >= 4:
-            raise gcmd.error('Wrong tool')
+    cmd_ACE_WAIT_READY_help = 'Wait until the ACE reports the requested status'
+    def cmd_ACE_WAIT_READY(self, gcmd):
+        timeout = gcmd.get_float('TIMEOUT', 60., minval=0.)
+        status = gcmd.get('STATUS', 'ready')
+        slot = gcmd.get_int('SLOT', None)
+
+        if slot is not None and (slot < 0 or slot >= SLOT_COUNT):
+            raise gcmd.error('Wrong slot')
+
+        def predicate(info):
+            if info.get('status') != status:
+                return False
+            if slot is not None:
+                slots = info.get('slots') or []
+                return slot < len(slots) and slots[slot].get('status') == 'ready'
+            return True
 
-        was = self.variables.get('ace_current_index', -1)
-        if was == tool:
-            gcmd.respond_info('ACE: Not changing tool, current index already ' + str(tool))
+        if not self.wait_for_status(predicate, timeout):
+            if not self._connected:
+                raise gcmd.error(f'ACE {self.serial_name} not connected within {timeout:.1f}s')
+            if slot is not None:
+                raise gcmd.error(f'ACE did not become {status} with slot {slot} ready within {timeout:.1f}s')
+            raise gcmd.error(f'ACE did not become {status} within {timeout:.1f}s')
+
+    cmd_ACE_TOOLCHANGE_STATS_help = 'Show toolchange phase and serial round trip timings'
+    def cmd_ACE_TOOLCHANGE_STATS(self, gcmd):
+        if gcmd.get_int('RESET', 0):
+            self._profiler.reset()
+            gcmd.respond_info('ACE: toolchange stats reset')
             return
 
-        if tool != -1:
-            status = self._info['slots'][tool]['status']
-            if status != 'ready':
-                self.gcode.run_script_from_command('_ACE_ON_EMPTY_ERROR INDEX=' + str(tool))
-                return
-
-        self.gcode.run_script_from_command('_ACE_PRE_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool))
-
-        logging.info('ACE: Toolchange ' + str(was) + ' => ' + str(tool))
-        if was != -1:
-            self._reject_tool(was)
-
-        if tool != -1:
-            self._feed(tool, self.toolchange_retract_length-5, self.retract_speed)
-            self.variables['ace_filament_pos'] = 'bowden'
-            self.wait_ace_ready()
-
-            self._park_to_toolhead(tool)
-
-        self.gcode.run_script_from_command('_ACE_POST_TOOLCHANGE FROM=' + str(was) + ' TO=' + str(tool))
-
-        self.variables['ace_current_index'] = tool
-        # Force save to disk
-        self._save_to_disk()
-        # self.gcode.run_script_from_command('SAVE_VARIABLE VARIABLE=ace_current_index VALUE=' + str(tool))
-        # self.gcode.run_script_from_command(f"""SAVE_VARIABLE VARIABLE=ace_filament_pos VALUE='"{self.variables['ace_filament_pos']}"'""")
-
-        gcmd.respond_info(f'Tool {tool} load')
+        slot = gcmd.get('SLOT', None)
+        stats = self._profiler.get_stats()
+        lines = []
+        # The profiler keys by string, slots arrive as '0'..'3'
+        for key in sorted(stats):
+            if slot is not None and key != slot:
+                continue
+            if key == 'serial':
+                title = 'Serial round trips'
+            elif key == '-1':
+                title = 'Unload only'
+            else:
+                title = f'Tool {self.first_tool + int(key)}'
+            lines.append(title + ':')
+            for phase, s in sorted(stats[key].items()):
+                lines.append(f'  {phase}: n={s["count"]} min={s["min"]:.3f} p50={s["p50"]:.3f} '
+                             f'p95={s["p95"]:.3f} max={s["max"]:.3f}')
+
+        gcmd.respond_info('\n'.join(lines) if lines else 'ACE: no toolchange stats yet')
+
+    cmd_ACE_DUMP_TRACE_help = 'Write the recent serial frames to a file'
+    def cmd_ACE_DUMP_TRACE(self, gcmd):
+        if not self.trace_size:
+            raise gcmd.error('ACE: tracing is off, set trace_size')
+        path = gcmd.get('FILE', None)
+        path = os.path.expanduser(path) if path else self._debug_path('trace', 'log')
+        count = self._trace.dump(path, f'{self._name} {self.serial_name}')
+        gcmd.respond_info(f'ACE: writing {count} trace records to {path}')
+
+    cmd_ACE_CAPTURE_help = 'Record the raw serial traffic for replay, ENABLE=1 to start and ENABLE=0 to stop'
+    def cmd_ACE_CAPTURE(self, gcmd):
+        enable = gcmd.get_int('ENABLE', None)
+        if enable is None:
+            if self._capture is None:
+                gcmd.respond_info('ACE: not capturing')
+            else:
+                gcmd.respond_info(f'ACE: capturing to {self._capture.path}, '
+                                  f'{self._capture.records} records, {self._capture.bytes}B')
+            return
 
+        if enable:
+            if self._capture is not None:
+                raise gcmd.error(f'ACE: already capturing to {self._capture.path}')
+            path = gcmd.get('FILE', None)
+            path = os.path.expanduser(path) if path else self._debug_path('capture', 'acecap')
+            try:
+                self._start_capture(path)
+            except OSError as e:
+                raise gcmd.error(f'ACE: cannot capture to {path}: {e}')
+            gcmd.respond_info(f'ACE: capturing to {path}')
+            return
 
-    cmd_ACE_FILAMENT_STATUS_help = 'ACE Filament status'
-    def cmd_ACE_FILAMENT_STATUS(self, gcmd):
-        sensor_extruder = self.printer.lookup_object('filament_switch_sensor %s' % 'extruder_sensor', None)
-        sensor_toolhead = self.printer.lookup_object('filament_switch_sensor %s' % 'toolhead_sensor', None)
-        state = 'ACE----------|*--|Ex--|*----|Nz--'
-        if  self.variables['ace_filament_pos'] == 'nozzle':
-            state = 'ACE>>>>>>>>>>|*>>|Ex>>|*>>|Nz>>'
-        if  self.variables['ace_filament_pos'] == 'toolhead' and bool(sensor_toolhead.runout_helper.filament_present):
-            state = 'ACE>>>>>>>>>>|*>>|Ex>>|*>>|Nz--'
-        if  self.variables['ace_filament_pos'] == 'toolhead' and not bool(sensor_toolhead.runout_helper.filament_present):
-            state = 'ACE>>>>>>>>>>|*>>|Ex>>|*--|Nz--'
-        if  self.variables['ace_filament_pos'] == 'bowden' and bool(sensor_extruder.runout_helper.filament_present):
-            state = 'ACE>>>>>>>>>>|*>>|Ex--|*--|Nz--'
-        if  self.variables['ace_filament_pos'] == 'bowden' and not bool(sensor_extruder.runout_helper.filament_present):
-            state = 'ACE>>>>>>>>>>|*--|Ex--|*--|Nz--'
-        gcmd.respond_info(state)
+        capture = self._stop_capture()
+        if capture is None:
+            gcmd.respond_info('ACE: not capturing')
+            return
+        gcmd.respond_info(f'ACE: captured {capture.records} records, {capture.bytes}B to {capture.path}')
 
     cmd_ACE_DEBUG_help = 'ACE Debug'
     def cmd_ACE_DEBUG(self, gcmd):
@@ -669,10 +2394,13 @@ class DuckAce:
             def callback(self, response):
                 self.gcode.respond_info(str(response))
 
-            self.send_request(request = {'method': method, 'params': json.loads(params)}, callback = callback)
+            self._send_command(request = {'method': method, 'params': json.loads(params)}, callback = callback)
         except Exception as e:
             self.gcode.respond_info('Error: ' + str(e))
 
 
 def load_config(config):
     return DuckAce(config)
+
+def load_config_prefix(config):
+    return DuckAce(config)
@@ -0,0 +1,355 @@
+# Serial session capture and replay for the ACE driver
+#
+# A capture is the raw byte stream of one unit in both directions. The file
+# starts with a magic line and a JSON line describing the session (unit name,
+# port, config options), followed by records of a little-endian header
+# (monotonic time as a double, kind as a byte, length as an unsigned int) and
+# the bytes exactly as they were written to or read from the port. ACE_CAPTURE
+# turns it on and off, the file is written from a thread.
+#
+# Replay feeds a capture through DuckAce's decoder, response handling and
+# callbacks on a virtual clock, at the recorded speed or faster, without a
+# printer or the ACE. Run it from the klippy directory:
+#
+#   python3 -m extras.ace_capture ace_capture.acecap
+#   python3 -m extras.ace_capture ace_capture.acecap --speed 0 --set park_detection=rate
+import argparse, json, logging, os, queue, struct, sys, tempfile, threading, time
+
+MAGIC = b'ACECAP 1\n'
+RECORD = struct.Struct('<dBI')
+
+TX = 0
+RX = 1
+LINK_UP = 2
+LINK_DOWN = 3
+
+class AceCaptureWriter:
+    def __init__(self, path, meta, clock=time.monotonic):
+        self.path = path
+        self._clock = clock
+        # Opened here so a bad path fails the command that asked for it
+        self._file = open(path, 'wb')
+        self._file.write(MAGIC)
+        self._file.write(json.dumps(meta).encode('utf-8') + b'\n')
+        self._queue = queue.Queue()
+        self.records = 0
+        self.bytes = 0
+        self.write_errors = 0
+        self._thread = threading.Thread(target=self._run, name='ace-capture', daemon=True)
+        self._thread.start()
+
+    def write(self, kind, data):
+        self._queue.put((self._clock(), kind, bytes(data)))
+        self.records += 1
+        self.bytes += len(data)
+
+    def close(self, timeout=5.):
+        self._queue.put(None)
+        self._thread.join(timeout)
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            timestamp, kind, data = item
+            try:
+                self._file.write(RECORD.pack(timestamp, kind, len(data)) + data)
+            except (OSError, ValueError):
+                self.write_errors += 1
+        try:
+            self._file.close()
+        except OSError:
+            logging.exception(f'ACE: closing capture {self.path} failed')
+
+def read_capture(path):
+    # Returns the session description and a list of (time, kind, data)
+    with open(path, 'rb') as f:
+        if f.readline() != MAGIC:
+            raise ValueError(f'{path} is not an ACE capture')
+        meta = json.loads(f.readline())
+        body = f.read()
+
+    records = []
+    pos = 0
+    while pos + RECORD.size <= len(body):
+        timestamp, kind, length = RECORD.unpack_from(body, pos)
+        pos += RECORD.size
+        if pos + length > len(body):
+            # Cut off mid-record, e.g. Klipper stopped while capturing
+            break
+        records.append((timestamp, kind, body[pos:pos + length]))
+        pos += length
+    return meta, records
+
+# Offline host, just enough of Klipper for a DuckAce to run its protocol layer
+
+class ReplayCompletion:
+    def __init__(self):
+        self.result = None
+        self.done = False
+
+    def complete(self, result):
+        self.result = result
+        self.done = True
+
+    def test(self):
+        return self.done
+
+    def wait(self, waketime=None, waketime_result=None):
+        # Nothing runs while waiting offline, a wait that isn't already over times out
+        return self.result if self.done else waketime_result
+
+class ReplayReactor:
+    NOW = 0.
+    NEVER = 9999999999999999.
+
+    def __init__(self):
+        self.now = 0.
+
+    def monotonic(self):
+        return self.now
+
+    def completion(self):
+        return ReplayCompletion()
+
+    def register_timer(self, callback, waketime=NEVER):
+        return [callback, waketime]
+
+    def update_timer(self, timer, waketime):
+        timer[1] = waketime
+
+    def unregister_timer(self, timer):
+        pass
+
+    def register_fd(self, fd, callback):
+        return fd
+
+    def unregister_fd(self, handle):
+        pass
+
+    def register_callback(self, callback, waketime=NOW):
+        # Main thread work (moves, macros) is not part of a replay
+        pass
+
+    def pause(self, waketime):
+        self.now = max(self.now, waketime)
+        return self.now
+
+class ReplayError(Exception):
+    pass
+
+class ReplayGCode:
+    error = ReplayError
+
+    def __init__(self, reactor, quiet):
+        self.reactor = reactor
+        self.quiet = quiet
+        self.start = None
+        self.messages = 0
+
+    def register_command(self, cmd, func, desc=None):
+        pass
+
+    def register_mux_command(self, cmd, key, value, func, desc=None):
+        pass
+
+    def respond_info(self, msg, log=True):
+        self.messages += 1
+        if not self.quiet:
+            print(f'{self.reactor.now - (self.start or self.reactor.now):10.3f} {msg}')
+
+    def respond_warn(self, msg):
+        self.respond_info('!! ' + msg)
+
+    def run_script_from_command(self, script):
+        self.respond_info('script: ' + script)
+
+    run_script = run_script_from_command
+
+class ReplaySaveVariables:
+    def __init__(self, directory):
+        self.filename = os.path.join(directory, 'variables.cfg')
+        self.allVariables = {}
+
+class ReplayPrinter:
+    def __init__(self, reactor, gcode, directory):
+        self.reactor = reactor
+        self.objects = {'gcode': gcode, 'save_variables': ReplaySaveVariables(directory), 'toolhead': None}
+        self.event_handlers = {}
+
+    def get_reactor(self):
+        return self.reactor
+
+    def lookup_object(self, name, default=ReplayError):
+        if name in self.objects:
+            return self.objects[name]
+        if default is ReplayError:
+            raise ReplayError(f'no {name} in a replay')
+        return default
+
+    def add_object(self, name, obj):
+        self.objects[name] = obj
+
+    def lookup_objects(self, module=None):
+        # Material profiles aren't part of a capture, [ace] values apply
+        return [(name, obj) for name, obj in self.objects.items()
+                if module is None or name == module or name.startswith(module + ' ')]
+
+    def register_event_handler(self, event, callback):
+        self.event_handlers.setdefault(event, []).append(callback)
+
+    def send_event(self, event, *params):
+        return [callback(*params) for callback in self.event_handlers.get(event, [])]
+
+    def get_start_args(self):
+        return {}
+
+class ReplayFileConfig:
+    def __init__(self, name, options):
+        self.sections = {name: options}
+
+    def items(self, section):
+        return list(self.sections.get(section, {}).items())
+
+class ReplayConfig:
+    error = ReplayError
+
+    def __init__(self, printer, name, options):
+        self.printer = printer
+        self.name = name
+        self.options = options
+        self.fileconfig = ReplayFileConfig(name, options)
+
+    def get_printer(self):
+        return self.printer
+
+    def get_name(self):
+        return self.name
+
+    def get_prefix_options(self, prefix):
+        return [option for option in self.options if option.startswith(prefix)]
+
+    def get(self, option, default=ReplayError, **kw):
+        if option in self.options:
+            return self.options[option]
+        if default is ReplayError:
+            raise ReplayError(f'option {option} missing from the capture')
+        return default
+
+    def getint(self, option, default=ReplayError, **kw):
+        value = self.get(option, default)
+        return int(value) if value is not None else None
+
+    def getfloat(self, option, default=ReplayError, **kw):
+        value = self.get(option, default)
+        return float(value) if value is not None else None
+
+    def getboolean(self, option, default=ReplayError, **kw):
+        value = self.get(option, default)
+        if isinstance(value, str):
+            return value.strip().lower() in ('1', 'true', 'yes', 'on')
+        return bool(value)
+
+    def getchoice(self, option, choices, default=ReplayError):
+        return choices[self.get(option, default)]
+
+def _replay_sent(ace, unit, data, decoder, eventtime):
+    # Rebuilds what the writer would have tracked for each request sent
+    decoder.feed(data)
+    for payload in decoder.frames():
+        try:
+            request = json.loads(str(payload, 'utf-8'))
+        except ValueError:
+            continue
+        id = request.get('id')
+        unit._protocol.last_id = max(unit._protocol.last_id, id or 0)
+        if request.get('method') == 'get_status' and 'params' not in request:
+            unit._heartbeat_id = id
+            unit._heartbeat_sent = eventtime
+            unit._heartbeat_deadline = eventtime + unit.request_timeout
+        elif id in unit._inflight:
+            unit._inflight[id].retries += 1
+        else:
+            task = ace.AceRequest(unit.reactor, request, None, False)
+            task.sent_time = eventtime
+            task.deadline = eventtime + unit.request_timeout
+            unit._protocol.expect(id, task)
+
+def replay(path, speed=1., overrides=None, quiet=False):
+    from . import ace, ace_codec
+
+    meta, records = read_capture(path)
+    directory = tempfile.mkdtemp(prefix='ace_replay_')
+    options = {key: value for key, value in meta.get('options', {}).items() if not key.endswith('_pin')}
+    # The replay must never touch the printer's real state
+    options['state_file'] = os.path.join(directory, 'ace_state.jsonl')
+    options.update(overrides or {})
+
+    reactor = ReplayReactor()
+    gcode = ReplayGCode(reactor, quiet)
+    printer = ReplayPrinter(reactor, gcode, directory)
+    unit = ace.DuckAce(ReplayConfig(printer, meta.get('name', 'ace'), options))
+    if records:
+        reactor.now = gcode.start = records[0][0]
+    unit._handle_ready()
+    unit._connected = True
+    tx_decoder = ace_codec.FrameDecoder()
+
+    print(f'Replaying {path}: {meta.get("name")} on {meta.get("serial")}, captured {meta.get("started")}, '
+          f'{len(records)} records', file=sys.stderr)
+    wall_start = time.monotonic()
+    handle_time = 0.
+    for timestamp, kind, data in records:
+        reactor.now = timestamp
+        if speed:
+            delay = wall_start + (timestamp - gcode.start) / speed - time.monotonic()
+            if delay > 0.:
+                time.sleep(delay)
+        if kind == TX:
+            _replay_sent(ace, unit, data, tx_decoder, timestamp)
+        elif kind == RX:
+            start = time.perf_counter()
+            unit._handle_rx(data)
+            handle_time += time.perf_counter() - start
+        elif kind == LINK_UP:
+            unit._connected = True
+            unit._protocol.decoder.reset()
+            tx_decoder.reset()
+        elif kind == LINK_DOWN:
+            unit._handle_link_lost(timestamp, str(data, 'utf-8', 'replace') or 'captured')
+    wall = time.monotonic() - wall_start
+    unit.tools.variables.close()
+
+    status = unit.get_status(reactor.now)
+    duration = records[-1][0] - records[0][0] if records else 0.
+    frames = unit._protocol.rx_frames
+    print(f'{duration:.1f}s captured, replayed in {wall:.2f}s; {frames} frames received, '
+          f'{status["rx_bytes"]}B, {status["crc_errors"]} crc errors, {gcode.messages} messages', file=sys.stderr)
+    if frames:
+        print(f'parse and callbacks {handle_time * 1000:.1f}ms, {handle_time / frames * 1e6:.1f}us per frame',
+              file=sys.stderr)
+    for key, phases in sorted(status['toolchange_stats'].items()):
+        for phase, s in sorted(phases.items()):
+            print(f'  {key} {phase}: n={s["count"]} p50={s["p50"]:.3f} p95={s["p95"]:.3f} max={s["max"]:.3f}',
+                  file=sys.stderr)
+    return unit
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay an ACE serial capture through the driver')
+    parser.add_argument('capture')
+    parser.add_argument('--speed', type=float, default=1., help='1 for recorded speed, 10 for ten times faster, 0 for no waiting')
+    parser.add_argument('--set', action='append', default=[], metavar='OPTION=VALUE',
+                        help='override a config option from the capture')
+    parser.add_argument('--quiet', action='store_true', help='leave out the messages the driver would show')
+    args = parser.parse_args()
+
+    overrides = {}
+    for item in args.set:
+        key, _, value = item.partition('=')
+        overrides[key.strip()] = value.strip()
+    logging.basicConfig(level=logging.WARNING)
+    replay(args.capture, args.speed, overrides, args.quiet)
+
+if __name__ == '__main__':
+    main()
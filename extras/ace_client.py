@@ -0,0 +1,212 @@
+# Asyncio client for the ACE Pro and a CLI for many units at once
+#
+# Uses the same protocol core as the Klipper driver, without Klipper: any
+# number of requests may be in flight, each waits on its own future and
+# unanswered ones are sent again with the same id, except feeds and retracts
+# which only wait longer. Don't point it at a port
+# Klipper has open, the unit only talks to one host at a time.
+#
+#   python3 ace_client.py /dev/serial/by-id/*ACE* info --firmware V1.3.84
+#   python3 ace_client.py /dev/ttyACM0 /dev/ttyACM1 --json inventory
+#   python3 ace_client.py '/dev/serial/by-id/*ACE*' dry --temp 50 --duration 240
+import argparse, asyncio, glob, json, sys
+
+import serial
+
+try:
+    from . import ace_protocol
+except ImportError:
+    import ace_protocol
+
+class AceError(Exception):
+    pass
+
+class AceClient:
+    def __init__(self, port, baud=115200, timeout=1., retries=2, max_inflight=4):
+        self.port = port
+        self.baud = baud
+        self.timeout = timeout
+        self.retries = retries
+        self.protocol = ace_protocol.AceProtocol()
+        self._serial = None
+        self._loop = None
+        self._error = None
+        self._slots = asyncio.Semaphore(max_inflight)
+
+    async def open(self):
+        self._loop = asyncio.get_running_loop()
+        self._serial = serial.Serial(port=self.port, baudrate=self.baud, timeout=0, write_timeout=self.timeout)
+        self._error = None
+        self._loop.add_reader(self._serial.fileno(), self._readable)
+        return self
+
+    async def close(self):
+        if self._serial is None:
+            return
+        self._loop.remove_reader(self._serial.fileno())
+        self._serial.close()
+        self._serial = None
+        for future in self.protocol.reset():
+            if not future.done():
+                future.set_exception(AceError(f'{self.port} closed'))
+
+    async def __aenter__(self):
+        return await self.open()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    def _readable(self):
+        try:
+            data = self._serial.read(4096)
+        except serial.SerialException as e:
+            # An unplugged port stays readable, leaving the reader in would spin the loop
+            self._loop.remove_reader(self._serial.fileno())
+            self._error = AceError(f'{self.port}: {e}')
+            for future in self.protocol.reset():
+                if not future.done():
+                    future.set_exception(AceError(f'{self.port}: {e}'))
+            return
+        for payload, response, future in self.protocol.receive(data):
+            if future is not None and not future.done():
+                future.set_result(response)
+
+    async def request(self, method, params=None):
+        # Returns the result, raises AceError on an error code or no answer
+        request = {'method': method}
+        if params is not None:
+            request['params'] = params
+        async with self._slots:
+            if self._error is not None:
+                raise self._error
+            payload = self.protocol.request_payload(request)
+            id = request['id']
+            resend = ace_protocol.may_resend(request)
+            future = self._loop.create_future()
+            self.protocol.expect(id, future)
+            try:
+                for attempt in range(self.retries + 1):
+                    if attempt == 0 or resend:
+                        self._serial.write(self.protocol.encode(payload))
+                    try:
+                        response = await asyncio.wait_for(asyncio.shield(future), self.timeout)
+                        break
+                    except asyncio.TimeoutError:
+                        continue
+                else:
+                    raise AceError(f'{self.port}: no response to {method}')
+            finally:
+                self.protocol.cancel(id)
+
+        if response.get('code', 0) != 0:
+            raise AceError(f'{self.port}: {method} failed: {response.get("msg")}')
+        return response.get('result')
+
+    async def get_info(self):
+        return await self.request('get_info')
+
+    async def get_status(self):
+        return await self.request('get_status')
+
+    async def start_drying(self, temp, duration=240, fan_speed=7000):
+        return await self.request('drying', {'temp': temp, 'fan_speed': fan_speed, 'duration': duration})
+
+    async def stop_drying(self):
+        return await self.request('drying_stop')
+
+    async def feed(self, index, length, speed):
+        return await self.request('feed_filament', {'index': index, 'length': length, 'speed': speed})
+
+    async def retract(self, index, length, speed):
+        return await self.request('unwind_filament', {'index': index, 'length': length, 'speed': speed})
+
+    async def enable_feed_assist(self, index):
+        return await self.request('start_feed_assist', {'index': index})
+
+    async def disable_feed_assist(self, index):
+        return await self.request('stop_feed_assist', {'index': index})
+
+# Fleet CLI
+
+async def _run_command(client, args):
+    if args.command == 'info':
+        info = await client.get_info()
+        if args.firmware and info.get('firmware') != args.firmware:
+            raise AceError(f'firmware {info.get("firmware")}, expected {args.firmware}')
+        return info
+    if args.command == 'status':
+        return await client.get_status()
+    if args.command == 'inventory':
+        status = await client.get_status()
+        return [{key: slot.get(key) for key in ('index', 'status', 'sku', 'type', 'color')}
+                for slot in status.get('slots') or ()]
+    if args.command == 'dry':
+        return await client.start_drying(args.temp, args.duration)
+    if args.command == 'stop-drying':
+        return await client.stop_drying()
+    return await client.request(args.method, json.loads(args.params) if args.params else None)
+
+async def _run_port(port, args):
+    try:
+        async with AceClient(port, args.baud, args.timeout, args.retries) as client:
+            return port, True, await _run_command(client, args)
+    except (AceError, serial.SerialException, OSError, ValueError) as e:
+        return port, False, str(e)
+
+def _format(command, result):
+    if command == 'info' and isinstance(result, dict):
+        return f'{result.get("model")} {result.get("firmware")}'
+    if command == 'inventory':
+        return '\n'.join(f'  {slot["index"]}: {slot["status"]} {slot["type"] or "-"} {slot["sku"] or "-"} '
+                         f'#{"".join("%02x" % c for c in slot["color"] or ())}' for slot in result)
+    if command == 'status' and isinstance(result, dict):
+        dryer = result.get('dryer') or {}
+        return (f'{result.get("status")}, {result.get("temp")}C, dryer {dryer.get("status")} '
+                f'{dryer.get("target_temp")}C {dryer.get("remain_time")}min left')
+    return json.dumps(result)
+
+async def _run_fleet(ports, args):
+    return await asyncio.gather(*(_run_port(port, args) for port in ports))
+
+def main():
+    parser = argparse.ArgumentParser(description='Query or command ACE Pro units in parallel')
+    parser.add_argument('ports', nargs='+', help='serial ports, shell patterns are expanded')
+    parser.add_argument('--baud', type=int, default=115200)
+    parser.add_argument('--timeout', type=float, default=1., help='seconds to wait for each answer')
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--json', action='store_true', help='print one JSON object per port')
+    commands = parser.add_subparsers(dest='command', required=True)
+    info = commands.add_parser('info', help='model and firmware')
+    info.add_argument('--firmware', help='fail the units not running this version')
+    commands.add_parser('status', help='status, temperature and dryer')
+    commands.add_parser('inventory', help='RFID sku, type and colour per slot')
+    dry = commands.add_parser('dry', help='start the dryer')
+    dry.add_argument('--temp', type=int, required=True)
+    dry.add_argument('--duration', type=int, default=240, help='minutes')
+    commands.add_parser('stop-drying', help='stop the dryer')
+    raw = commands.add_parser('raw', help='send any request')
+    raw.add_argument('method')
+    raw.add_argument('--params', help='JSON object')
+    args = parser.parse_args()
+
+    ports = []
+    for pattern in args.ports:
+        ports.extend(sorted(glob.glob(pattern)) if glob.has_magic(pattern) else [pattern])
+    if not ports:
+        parser.error('no ports matched')
+
+    failed = 0
+    for port, ok, result in asyncio.run(_run_fleet(ports, args)):
+        failed += not ok
+        if args.json:
+            print(json.dumps({'port': port, 'ok': ok, 'result' if ok else 'error': result}))
+        elif not ok:
+            print(f'{port}: error: {result}')
+        elif args.command == 'inventory':
+            print(f'{port}:\n{_format(args.command, result)}')
+        else:
+            print(f'{port}: {_format(args.command, result)}')
+    sys.exit(1 if failed else 0)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,189 @@
+# Frame codec for the Anycubic ACE Pro serial protocol
+#
+# Frame layout: 0xFF 0xAA | payload length (u16 LE) | JSON payload | CRC16 (u16 LE) | 0xFE
+# The CRC is CRC-16/MCRF4XX (reflected 0x1021, init 0xFFFF) over the payload only.
+import struct, time, json
+
+HEADER = b'\xFF\xAA'
+TAIL = 0xFE
+FRAME_OVERHEAD = 7
+MAX_PAYLOAD = 4096
+
+def _build_crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            if crc & 1:
+                crc = (crc >> 1) ^ 0x8408
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC_TABLE = _build_crc_table()
+
+def calc_crc(data, crc=0xffff):
+    table = CRC_TABLE
+    for byte in data:
+        crc = (crc >> 8) ^ table[(crc ^ byte) & 0xff]
+    return crc
+
+
+class FrameEncoder:
+    def __init__(self, max_payload=MAX_PAYLOAD):
+        self.max_payload = max_payload
+        self._buffer = bytearray(max_payload + FRAME_OVERHEAD)
+        self._view = memoryview(self._buffer)
+        self._buffer[0:2] = HEADER
+
+    def encode(self, payload):
+        # The returned view points into the shared buffer and is only valid
+        # until the next call, write it out before encoding another frame
+        length = len(payload)
+        if length > self.max_payload:
+            raise ValueError('ACE payload too long: %d bytes' % (length,))
+
+        buffer = self._buffer
+        struct.pack_into('<H', buffer, 2, length)
+        buffer[4:4 + length] = payload
+        struct.pack_into('<HB', buffer, 4 + length, calc_crc(payload), TAIL)
+        return self._view[:length + FRAME_OVERHEAD]
+
+
+class FrameDecoder:
+    def __init__(self, max_payload=MAX_PAYLOAD, size=None):
+        self.max_payload = max_payload
+        if size is None:
+            size = 4 * (max_payload + FRAME_OVERHEAD)
+        self._buffer = bytearray(size)
+        self._view = memoryview(self._buffer)
+        self._start = 0
+        self._end = 0
+        self.crc_errors = 0
+        self.framing_errors = 0
+        self.dropped_bytes = 0
+
+    def reset(self):
+        self._start = self._end = 0
+
+    def pending(self):
+        return self._end - self._start
+
+    def feed(self, data):
+        length = len(data)
+        if length > len(self._buffer) - self._end:
+            # Move the unparsed tail to the front before appending
+            pending = self._end - self._start
+            self._buffer[:pending] = self._view[self._start:self._end]
+            self._start, self._end = 0, pending
+            if length > len(self._buffer) - pending:
+                # Nothing sane is that long, start again from the new data
+                self.dropped_bytes += pending
+                self._start = self._end = 0
+                data = data[-len(self._buffer):]
+                length = len(data)
+
+        self._buffer[self._end:self._end + length] = data
+        self._end += length
+
+    def next_frame(self):
+        # Returns a view of the next valid payload, valid until the next feed()
+        buffer = self._buffer
+        while True:
+            start, end = self._start, self._end
+            if end - start < 4:
+                return None
+
+            header = buffer.find(HEADER, start, end)
+            if header < 0:
+                # Keep a trailing 0xFF, it may be the first half of a header
+                keep = 1 if buffer[end - 1] == 0xFF else 0
+                self.dropped_bytes += end - start - keep
+                self._start = end - keep
+                return None
+            if header != start:
+                self.dropped_bytes += header - start
+                self._start = start = header
+                if end - start < 4:
+                    return None
+
+            length = buffer[start + 2] | (buffer[start + 3] << 8)
+            if length > self.max_payload:
+                self.framing_errors += 1
+                self._start = start + 1
+                continue
+
+            frame_end = start + 4 + length + 3
+            if frame_end > end:
+                return None
+
+            payload_end = start + 4 + length
+            if buffer[frame_end - 1] != TAIL:
+                self.framing_errors += 1
+                self._start = start + 1
+                continue
+
+            payload = self._view[start + 4:payload_end]
+            crc = buffer[payload_end] | (buffer[payload_end + 1] << 8)
+            if calc_crc(payload) != crc:
+                self.crc_errors += 1
+                self._start = start + 1
+                continue
+
+            if frame_end == end:
+                self._start = self._end = 0
+            else:
+                self._start = frame_end
+            return payload
+
+    def frames(self):
+        while True:
+            payload = self.next_frame()
+            if payload is None:
+                return
+            yield payload
+
+
+def benchmark(count=20000):
+    status = {
+        'id': 1234,
+        'code': 0,
+        'msg': 'success',
+        'result': {
+            'status': 'ready',
+            'dryer': {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0},
+            'temp': 25, 'enable_rfid': 1, 'fan_speed': 7000,
+            'feed_assist_count': 0, 'cont_assist_time': 0.0,
+            'slots': [{'index': i, 'status': 'ready', 'sku': 'AHPLBK-101', 'type': 'PLA',
+                       'color': [0, 0, 0]} for i in range(4)],
+        },
+    }
+    payload = json.dumps(status).encode('utf-8')
+    encoder = FrameEncoder()
+    frame = bytes(encoder.encode(payload))
+
+    start = time.perf_counter()
+    for _ in range(count):
+        encoder.encode(payload)
+    encode_time = time.perf_counter() - start
+
+    decoder = FrameDecoder()
+    start = time.perf_counter()
+    for _ in range(count):
+        decoder.feed(frame)
+        for _ in decoder.frames():
+            pass
+    decode_time = time.perf_counter() - start
+
+    return {
+        'frame_bytes': len(frame),
+        'encode_fps': count / encode_time,
+        'decode_fps': count / decode_time,
+    }
+
+if __name__ == '__main__':
+    res = benchmark()
+    print('ACE status frame: %d bytes' % (res['frame_bytes'],))
+    print('encode: %.0f frames/s' % (res['encode_fps'],))
+    print('decode: %.0f frames/s (CRC checked)' % (res['decode_fps'],))
@@ -0,0 +1,66 @@
+# Material profiles for the ACE driver
+#
+# An [ace_material NAME] section overrides the [ace] speeds and lengths for
+# the slots holding that material. A slot matches a profile by RFID sku
+# first, then by filament type (NAME unless type: is given), and
+# [ace_material default] covers everything else. Units resolve a slot when
+# the heartbeat reports new contents and keep the result until it changes.
+#
+# [ace_material PLA]
+# feed_speed: 150
+# retract_speed: 150
+#
+# [ace_material TPU]
+# feed_speed: 20
+# retract_speed: 20
+# toolhead_approach_speed: 10
+# disable_assist_after_toolchange: True
+# purge_length: 120
+# purge_temp: 230
+
+# Options that fall back to the unit's own value when a profile leaves them out
+OVERRIDES = ('feed_speed', 'retract_speed', 'toolchange_retract_length', 'extract_speed',
+             'toolhead_approach_speed', 'toolhead_fast_speed', 'disable_assist_after_toolchange')
+
+class AceMaterial:
+    def __init__(self, config):
+        self.name = config.get_name().split(None, 1)[-1]
+        self.type = config.get('type', self.name).strip().upper()
+        self.skus = tuple(sku.strip() for sku in config.getlist('sku', ()) if sku.strip())
+
+        self.feed_speed = config.getint('feed_speed', None, minval=1)
+        self.retract_speed = config.getint('retract_speed', None, minval=1)
+        self.toolchange_retract_length = config.getint('toolchange_retract_length', None, minval=10)
+        self.extract_speed = config.getfloat('extract_speed', None, above=0.)
+        self.toolhead_approach_speed = config.getfloat('toolhead_approach_speed', None, above=0.)
+        self.toolhead_fast_speed = config.getfloat('toolhead_fast_speed', None, above=0.)
+        self.disable_assist_after_toolchange = config.getboolean('disable_assist_after_toolchange', None)
+        # Hints for the toolchange macros, passed as PURGE_LENGTH= and PURGE_TEMP=
+        self.purge_length = config.getfloat('purge_length', None, minval=0.)
+        self.purge_temp = config.getfloat('purge_temp', None, minval=0.)
+
+        self._status = {'type': self.type, 'sku': self.skus}
+        for option in OVERRIDES + ('purge_length', 'purge_temp'):
+            self._status[option] = getattr(self, option)
+
+    def get_status(self, eventtime=None):
+        return self._status
+
+def find(printer, sku, filament_type):
+    materials = [material for name, material in printer.lookup_objects('ace_material')]
+    if sku:
+        for material in materials:
+            if sku in material.skus:
+                return material
+    if filament_type:
+        filament_type = filament_type.upper()
+        for material in materials:
+            if material.type == filament_type:
+                return material
+    for material in materials:
+        if material.name == 'default':
+            return material
+    return None
+
+def load_config_prefix(config):
+    return AceMaterial(config)
@@ -0,0 +1,91 @@
+# Host-independent core of the ACE Pro serial protocol
+#
+# Framing, request ids and matching responses to whatever waits for them,
+# with no I/O and no clock of its own: the host writes the frames encode()
+# returns, hands everything it reads to receive() and decides by itself when a
+# request has waited too long. DuckAce drives it from Klipper's reactor,
+# ace_client from asyncio.
+import json
+
+try:
+    from . import ace_codec
+except ImportError:
+    import ace_codec
+
+# Ids wrap around below what the ACE firmware accepts
+MAX_REQUEST_ID = 16382
+
+# Movements may have started before a link drop or a lost answer, sending them
+# again could double them. Hosts never resend them, everything else may be sent
+# again after a timeout or a reconnect
+NO_REPLAY_METHODS = frozenset(('feed_filament', 'unwind_filament'))
+
+def may_resend(request):
+    return request.get('method') not in NO_REPLAY_METHODS
+
+class AceProtocol:
+    def __init__(self, max_payload=ace_codec.MAX_PAYLOAD):
+        self.encoder = ace_codec.FrameEncoder(max_payload)
+        self.decoder = ace_codec.FrameDecoder(max_payload)
+        self.last_id = 0
+        # id -> the host's waiter (a request task, a future), until answered or cancelled
+        self.pending = {}
+        self.tx_bytes = 0
+        self.rx_bytes = 0
+        self.rx_frames = 0
+        self.invalid_frames = 0
+
+    @property
+    def crc_errors(self):
+        return self.decoder.crc_errors
+
+    def next_id(self):
+        # Skips ids still waiting, a slow answer never completes the wrong request
+        while True:
+            self.last_id = self.last_id + 1 if self.last_id < MAX_REQUEST_ID else 1
+            if self.last_id not in self.pending:
+                return self.last_id
+
+    def request_payload(self, request):
+        # Gives the request an id if it has none
+        if 'id' not in request:
+            request['id'] = self.next_id()
+        return json.dumps(request).encode('utf-8')
+
+    def encode(self, payload):
+        # The frame is only valid until the next call, write it out first
+        frame = self.encoder.encode(payload)
+        self.tx_bytes += len(frame)
+        return frame
+
+    def expect(self, id, waiter):
+        self.pending[id] = waiter
+
+    def cancel(self, id):
+        return self.pending.pop(id, None)
+
+    def receive(self, data):
+        # Yields (payload, response, waiter) for every complete frame. response is
+        # None when the frame isn't a JSON object, waiter is None when nothing
+        # waits for its id. The payload is a view that is valid until the next call
+        self.decoder.feed(data)
+        self.rx_bytes += len(data)
+        for payload in self.decoder.frames():
+            self.rx_frames += 1
+            try:
+                response = json.loads(str(payload, 'utf-8'))
+            except ValueError:
+                response = None
+            if not isinstance(response, dict):
+                self.invalid_frames += 1
+                yield payload, None, None
+                continue
+            yield payload, response, self.pending.pop(response.get('id'), None)
+
+    def reset(self):
+        # After the link drops: partial frames are thrown away and the waiters
+        # handed back for the host to fail or send again
+        self.decoder.reset()
+        waiters = list(self.pending.values())
+        self.pending.clear()
+        return waiters
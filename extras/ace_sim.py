@@ -0,0 +1,312 @@
+# Simulated ACE Pro on a pseudo-terminal
+#
+# Speaks the same framing as the real unit through ace_codec and answers
+# get_info, get_status, feed/unwind (and their stops), feed assist, speed
+# updates and the dryer with configurable timing and injected faults.
+# Point [ace] serial at the --link path to run Klipper against it, or use
+# --bench to measure round trips without Klipper:
+#
+#   python3 ace_sim.py --link /tmp/ttyACE --latency 0.005 --drop 0.01
+#   python3 ace_sim.py --link /tmp/ttyACE --bench 1000
+import argparse, errno, heapq, json, os, random, select, sys, time, tty
+
+try:
+    from . import ace_codec
+except ImportError:
+    import ace_codec
+
+class AceSimulator:
+    def __init__(self, args):
+        self.args = args
+        self.rng = random.Random(args.seed)
+        self.encoder = ace_codec.FrameEncoder()
+        self.decoder = ace_codec.FrameDecoder()
+        self.master = None
+        self.slave = None
+        self.port = None
+        self._events = []
+        self._seq = 0
+        self._motion = None
+        self._assist_started = 0.
+        self._assist_base = 0
+        self._assist_time_base = 0.
+        self._dryer_start = 0.
+        self._dryer_end = 0.
+        self._next_disconnect = None
+        self.stats = {'requests': {}, 'dropped': 0, 'corrupted': 0, 'disconnects': 0,
+                      'rx_bytes': 0, 'tx_bytes': 0}
+        self._poll_times = []
+        self.info = {
+            'status': 'ready',
+            'dryer': {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0},
+            'temp': 25,
+            'enable_rfid': 1,
+            'fan_speed': 7000,
+            'feed_assist_count': 0,
+            'cont_assist_time': 0.0,
+            'slots': [{'index': i, 'status': 'ready', 'sku': f'SIM-{i}', 'type': 'PLA',
+                       'color': [255 * (i & 1), 255 * ((i >> 1) & 1), 128]} for i in range(4)],
+        }
+        self.feed_assist_index = -1
+
+    # Pseudo-terminal
+
+    def open(self):
+        self.master, self.slave = os.openpty()
+        tty.setraw(self.slave)
+        os.set_blocking(self.master, False)
+        self.port = os.ttyname(self.slave)
+        if self.args.link:
+            try:
+                os.unlink(self.args.link)
+            except FileNotFoundError:
+                pass
+            os.symlink(self.port, self.args.link)
+        self.decoder.reset()
+        if self.args.disconnect_every:
+            self._next_disconnect = time.monotonic() + self.args.disconnect_every
+        print(f'ACE simulator on {self.args.link or self.port}', file=sys.stderr)
+
+    def close(self, remove_link=True):
+        for fd in (self.master, self.slave):
+            if fd is not None:
+                os.close(fd)
+        self.master = self.slave = None
+        if remove_link and self.args.link:
+            try:
+                os.unlink(self.args.link)
+            except FileNotFoundError:
+                pass
+
+    def disconnect(self):
+        # Like a USB drop: the port and its path go away for a while
+        self.stats['disconnects'] += 1
+        self.close()
+        self._motion = None
+        self.info['status'] = 'ready'
+        self.schedule(self.args.reconnect_delay, self.open)
+
+    # Event loop
+
+    def schedule(self, delay, callback):
+        self._seq += 1
+        heapq.heappush(self._events, (time.monotonic() + delay, self._seq, callback))
+
+    def run(self, duration=None):
+        end = time.monotonic() + duration if duration else None
+        next_stats = time.monotonic() + self.args.stats if self.args.stats else None
+        while end is None or time.monotonic() < end:
+            now = time.monotonic()
+            while self._events and self._events[0][0] <= now:
+                heapq.heappop(self._events)[2]()
+            self._tick(now)
+            if next_stats is not None and now >= next_stats:
+                self.print_stats()
+                next_stats = now + self.args.stats
+            if self._next_disconnect is not None and now >= self._next_disconnect and self.master is not None:
+                self._next_disconnect = None
+                self.disconnect()
+                continue
+
+            timeout = 0.05
+            if self._events:
+                timeout = min(timeout, max(0., self._events[0][0] - now))
+            if end is not None:
+                timeout = min(timeout, max(0., end - now))
+            if self.master is None:
+                time.sleep(timeout)
+                continue
+            readable, _, _ = select.select([self.master], [], [], timeout)
+            if readable:
+                self._read()
+
+    def _read(self):
+        try:
+            data = os.read(self.master, 4096)
+        except OSError as e:
+            if e.errno in (errno.EAGAIN, errno.EIO):
+                return
+            raise
+        self.stats['rx_bytes'] += len(data)
+        self.decoder.feed(data)
+        for payload in self.decoder.frames():
+            try:
+                request = json.loads(str(payload, 'utf-8'))
+            except ValueError:
+                continue
+            self._handle(request)
+
+    def _send(self, response):
+        if self.master is None:
+            return
+        frame = bytearray(self.encoder.encode(json.dumps(response).encode('utf-8')))
+        if self.rng.random() < self.args.corrupt:
+            self.stats['corrupted'] += 1
+            frame[4 + self.rng.randrange(len(frame) - 7)] ^= 0x20
+        try:
+            os.write(self.master, frame)
+            self.stats['tx_bytes'] += len(frame)
+        except OSError:
+            pass
+
+    def _respond(self, request, result=None, code=0, msg='success'):
+        if self.rng.random() < self.args.drop:
+            self.stats['dropped'] += 1
+            return
+        response = {'id': request.get('id'), 'code': code, 'msg': msg}
+        if result is not None:
+            response['result'] = result
+        delay = self.args.latency + self.rng.random() * self.args.jitter
+        self.schedule(delay, lambda: self._send(response))
+
+    # Device model
+
+    def _tick(self, now):
+        if self._motion is not None and now >= self._motion['end']:
+            self._motion = None
+            self.info['status'] = 'ready'
+        if self.feed_assist_index != -1 and now - self._assist_started < self.args.park_time:
+            # The counter only moves while the extruder is still pulling filament in
+            elapsed = now - self._assist_started
+            self.info['feed_assist_count'] = self._assist_base + int(elapsed * self.args.assist_rate)
+            self.info['cont_assist_time'] = round(self._assist_time_base + elapsed, 2)
+        dryer = self.info['dryer']
+        if dryer['status'] == 'drying':
+            remain = max(0, int(self._dryer_end - now) // 60)
+            dryer['remain_time'] = remain
+            self.info['temp'] = min(dryer['target_temp'], 25 + int((now - self._dryer_start) * 0.5))
+            if now >= self._dryer_end:
+                dryer.update(status='stop', target_temp=0, duration=0, remain_time=0)
+        elif self.info['temp'] > 25:
+            self.info['temp'] = max(25, self.info['temp'] - 1)
+
+    def _handle(self, request):
+        method = request.get('method')
+        params = request.get('params') or {}
+        counts = self.stats['requests']
+        counts[method] = counts.get(method, 0) + 1
+        if method == 'get_status':
+            self._poll_times.append(time.monotonic())
+
+        if method == 'get_info':
+            self._respond(request, {'id': 0, 'slots': 4, 'model': 'Anycubic Color Engine Pro (sim)',
+                                    'firmware': 'V1.3.84-sim', 'boot_firmware': 'V1.0.1',
+                                    'structure_version': '0'})
+        elif method == 'get_status':
+            self._respond(request, json.loads(json.dumps(self.info)))
+        elif method in ('feed_filament', 'unwind_filament'):
+            if self._motion is not None:
+                self._respond(request, code=1, msg='busy')
+                return
+            speed = params.get('speed') or self.args.feed_speed
+            duration = params.get('length', 0) / min(speed, self.args.max_speed)
+            self._motion = {'method': method, 'index': params.get('index'), 'end': time.monotonic() + duration}
+            self.info['status'] = 'busy'
+            self._respond(request)
+        elif method in ('stop_feed_filament', 'stop_unwind_filament'):
+            self._motion = None
+            self.info['status'] = 'ready'
+            self._respond(request)
+        elif method == 'start_feed_assist':
+            self.feed_assist_index = params.get('index', -1)
+            self._assist_started = time.monotonic()
+            self._assist_base = self.info['feed_assist_count']
+            self._assist_time_base = self.info['cont_assist_time']
+            self._respond(request)
+        elif method == 'stop_feed_assist':
+            self.feed_assist_index = -1
+            self._respond(request)
+        elif method in ('update_feeding_speed', 'update_unwinding_speed'):
+            self._respond(request)
+        elif method == 'drying':
+            duration = params.get('duration', 240)
+            self._dryer_start = time.monotonic()
+            self._dryer_end = self._dryer_start + duration * 60
+            self.info['dryer'] = {'status': 'drying', 'target_temp': params.get('temp', 0),
+                                  'duration': duration, 'remain_time': duration}
+            self._respond(request)
+        elif method == 'drying_stop':
+            self.info['dryer'] = {'status': 'stop', 'target_temp': 0, 'duration': 0, 'remain_time': 0}
+            self._respond(request)
+        else:
+            self._respond(request, code=-1, msg=f'unknown method {method}')
+
+    def print_stats(self):
+        polls = self._poll_times
+        interval = ''
+        if len(polls) > 1:
+            gaps = [b - a for a, b in zip(polls, polls[1:])]
+            interval = f' poll interval avg {sum(gaps) / len(gaps) * 1000:.0f}ms'
+        self._poll_times = polls[-1:]
+        print(f'requests {self.stats["requests"]} rx {self.stats["rx_bytes"]}B tx {self.stats["tx_bytes"]}B '
+              f'dropped {self.stats["dropped"]} corrupted {self.stats["corrupted"]} '
+              f'disconnects {self.stats["disconnects"]}{interval}', file=sys.stderr)
+
+
+def bench(sim, count):
+    # A client on the slave side measuring get_status round trips through the simulator
+    fd = os.open(sim.port, os.O_RDWR | os.O_NOCTTY | os.O_NONBLOCK)
+    encoder = ace_codec.FrameEncoder()
+    decoder = ace_codec.FrameDecoder()
+    rtts = []
+    lost = 0
+    for i in range(1, count + 1):
+        payload = b'{"id": %d, "method": "get_status"}' % (i,)
+        start = time.monotonic()
+        os.write(fd, encoder.encode(payload))
+        deadline = start + 0.5
+        answered = False
+        while not answered and time.monotonic() < deadline:
+            sim.run(0.0005)
+            try:
+                decoder.feed(os.read(fd, 4096))
+            except BlockingIOError:
+                continue
+            for frame in decoder.frames():
+                if json.loads(str(frame, 'utf-8')).get('id') == i:
+                    rtts.append(time.monotonic() - start)
+                    answered = True
+        if not answered:
+            lost += 1
+    os.close(fd)
+
+    rtts.sort()
+    if rtts:
+        print(f'{len(rtts)} round trips, lost {lost}: min {rtts[0] * 1000:.2f}ms '
+              f'p50 {rtts[len(rtts) // 2] * 1000:.2f}ms p95 {rtts[int(len(rtts) * 0.95) - 1] * 1000:.2f}ms '
+              f'max {rtts[-1] * 1000:.2f}ms, crc errors {decoder.crc_errors}')
+    else:
+        print(f'no answers, lost {lost}')
+
+def main():
+    parser = argparse.ArgumentParser(description='Simulated ACE Pro on a pseudo-terminal')
+    parser.add_argument('--link', help='symlink to the PTY, use it as [ace] serial')
+    parser.add_argument('--latency', type=float, default=0.002, help='response delay in seconds')
+    parser.add_argument('--jitter', type=float, default=0.001, help='random extra delay in seconds')
+    parser.add_argument('--feed-speed', type=float, default=50., help='speed when a request has none, mm/s')
+    parser.add_argument('--max-speed', type=float, default=150., help='fastest the motors go, mm/s')
+    parser.add_argument('--assist-rate', type=float, default=10., help='feed assist counts per second while pulling')
+    parser.add_argument('--park-time', type=float, default=3., help='seconds feed assist pulls before parking')
+    parser.add_argument('--drop', type=float, default=0., help='probability a response is lost')
+    parser.add_argument('--corrupt', type=float, default=0., help='probability a response has a flipped byte')
+    parser.add_argument('--disconnect-every', type=float, default=0., help='drop the port every N seconds')
+    parser.add_argument('--reconnect-delay', type=float, default=1., help='seconds the port stays away')
+    parser.add_argument('--stats', type=float, default=10., help='print statistics every N seconds, 0 for never')
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--bench', type=int, default=0, help='measure N get_status round trips and exit')
+    args = parser.parse_args()
+
+    sim = AceSimulator(args)
+    sim.open()
+    try:
+        if args.bench:
+            bench(sim, args.bench)
+        else:
+            sim.run()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sim.close()
+
+if __name__ == '__main__':
+    main()
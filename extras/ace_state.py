@@ -0,0 +1,149 @@
+# Journaled state for the ACE driver
+#
+# The store is a dict: every assignment is appended to the journal as one
+# JSON line by a writer thread, so the G-code path never waits on the disk.
+# Changes that queue up while a write is in progress go out together as one
+# line, and the journal is rewritten as a single snapshot line once it grows
+# past compact_lines. On startup the journal is replayed in order, a line torn
+# by a crash is skipped.
+import json, logging, os, threading, queue
+
+class AceStateStore(dict):
+    def __init__(self, path, mirror=None, compact_lines=1000):
+        dict.__init__(self)
+        self.path = path
+        self.compact_lines = compact_lines
+        # Values are also copied here, e.g. save_variables for macros to read
+        self._mirror = mirror
+        self._queue = queue.Queue()
+        self._thread = None
+        self._file = None
+        self._lines = 0
+        self._persisted = {}
+        self.writes = 0
+        self.write_errors = 0
+        # Bumped on every change, readers cache against it
+        self.version = 0
+
+    def __setitem__(self, key, value):
+        dict.__setitem__(self, key, value)
+        self.version += 1
+        if self._mirror is not None:
+            self._mirror[key] = value
+        # Encoded here, the writer thread never looks at live objects
+        self._queue.put((key, json.dumps(value)))
+
+    def load(self):
+        # Returns False when there is no journal yet
+        try:
+            with open(self.path, 'r') as f:
+                lines = f.readlines()
+        except FileNotFoundError:
+            return False
+
+        bad = 0
+        for line in lines:
+            try:
+                changes = json.loads(line)
+            except ValueError:
+                bad += 1
+                continue
+            for key, value in changes.items():
+                dict.__setitem__(self, key, value)
+                self._persisted[key] = json.dumps(value)
+        if bad:
+            logging.warning(f'ACE: skipped {bad} damaged line(s) in {self.path}')
+
+        if self._mirror is not None:
+            self._mirror.update(self)
+        self._lines = len(lines)
+        if bad or self._lines >= self.compact_lines:
+            self._compact()
+        return True
+
+    def start(self):
+        self._thread = threading.Thread(target=self._run, name='ace-state', daemon=True)
+        self._thread.start()
+
+    def flush(self, timeout=5.):
+        if self._thread is None:
+            return True
+        done = threading.Event()
+        self._queue.put(done)
+        return done.wait(timeout)
+
+    def close(self, timeout=5.):
+        if self._thread is None:
+            return
+        self._queue.put(None)
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            changes = {}
+            flushed = []
+            stop = False
+            while True:
+                if item is None:
+                    stop = True
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    changes[item[0]] = item[1]
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+
+            if changes:
+                self._append(changes)
+            for done in flushed:
+                done.set()
+            if stop:
+                self._close_file()
+                return
+
+    def _append(self, changes):
+        self._persisted.update(changes)
+        line = '{' + ', '.join(f'{json.dumps(key)}: {value}' for key, value in changes.items()) + '}\n'
+        try:
+            if self._file is None:
+                self._file = open(self.path, 'a')
+            self._file.write(line)
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            self._lines += 1
+            self.writes += 1
+        except OSError:
+            logging.exception(f'ACE: writing {self.path} failed')
+            self.write_errors += 1
+            self._close_file()
+            return
+
+        if self._lines >= self.compact_lines:
+            self._compact()
+
+    def _compact(self):
+        snapshot = '{' + ', '.join(f'{json.dumps(key)}: {value}' for key, value in self._persisted.items()) + '}\n'
+        tmp_path = self.path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as f:
+                f.write(snapshot)
+                f.flush()
+                os.fsync(f.fileno())
+            self._close_file()
+            os.replace(tmp_path, self.path)
+            self._lines = 1
+        except OSError:
+            logging.exception(f'ACE: compacting {self.path} failed')
+            self.write_errors += 1
+
+    def _close_file(self):
+        if self._file is not None:
+            try:
+                self._file.close()
+            except OSError:
+                pass
+            self._file = None
@@ -0,0 +1,60 @@
+# Frame trace for the ACE driver
+#
+# A fixed size ring of the frames sent and received plus link anomalies. A
+# record is a tuple of monotonic time, direction, id, method and the raw JSON
+# payload, nothing is formatted while frames go by. Dumps take a snapshot of
+# the ring and write it out as text from a thread.
+import logging, os, threading, time
+from datetime import datetime
+
+TX = '>'
+RX = '<'
+EVENT = '!'
+
+class AceTrace:
+    def __init__(self, size, clock=time.monotonic):
+        self.size = size
+        self._clock = clock
+        self._entries = [None] * size
+        self._pos = 0
+        self.count = 0
+
+    def record(self, direction, id, method, data):
+        if not self.size:
+            return
+        self._entries[self._pos] = (self._clock(), direction, id, method, data)
+        self._pos += 1
+        if self._pos == self.size:
+            self._pos = 0
+        self.count += 1
+
+    def snapshot(self):
+        # Oldest first
+        entries = self._entries[self._pos:] + self._entries[:self._pos]
+        return [entry for entry in entries if entry is not None]
+
+    def dump(self, path, title=''):
+        # Returns the number of records written in the background
+        entries = self.snapshot()
+        # Lets the monotonic times be matched against klippy.log
+        header = (f'# {title} dumped {datetime.now().strftime("%Y-%m-%d %H:%M:%S")} '
+                  f'monotonic {self._clock():.6f}, {len(entries)} of {self.count} records\n')
+        thread = threading.Thread(target=self._write, args=(path, header, entries),
+                                  name='ace-trace', daemon=True)
+        thread.start()
+        return len(entries)
+
+    @staticmethod
+    def _write(path, header, entries):
+        try:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(header)
+                for timestamp, direction, id, method, data in entries:
+                    if isinstance(data, (bytes, bytearray)):
+                        data = str(data, 'utf-8', 'replace')
+                    f.write(f'{timestamp:.6f} {direction} {id} {method} {data}\n')
+        except OSError:
+            logging.exception(f'ACE: writing trace {path} failed')
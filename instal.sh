@@ -61,7 +61,9 @@ check_folders()
 link_extension()
 {
     echo -n "Linking extension to Klipper... "
-    ln -sf "${SRCDIR}/extras/ace.py" "${KLIPPER_HOME}/klippy/extras/ace.py"
+    for module in "${SRCDIR}"/extras/ace*.py; do
+        ln -sf "${module}" "${KLIPPER_HOME}/klippy/extras/$(basename "${module}")"
+    done
     echo "[OK]"
 }
 
@@ -76,7 +78,7 @@ uninstall()
 {
     if [ -f "${KLIPPER_HOME}/klippy/extras/ace.py" ]; then
         echo -n "Uninstalling... "
-        rm -f "${KLIPPER_HOME}/klippy/extras/ace.py"
+        rm -f "${KLIPPER_HOME}"/klippy/extras/ace*.py
         echo "[OK]"
         echo "You can now remove the [update_manager FrogAce] section in your moonraker.conf and delete this directory. Also remove all led_effect configurations from your Klipper configuration."
     else